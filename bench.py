@@ -0,0 +1,318 @@
+"""
+Benchmark offline del bot: niente chiamate vere a Discogs o Telegram.
+
+Avvia un server locale che imita api.discogs.com (wantlist paginata,
+/marketplace/stats con latenza, header di rate limit e 429 iniettati) e
+l'endpoint sendMessage di Telegram, poi fa girare get_wantlist e
+monitor_stats_stable di main.py contro quel server su wantlist sintetiche.
+
+Uso:
+    python bench.py --sizes 100,1000,10000 --cycles 3
+    python bench.py --sizes 50000 --rate 20000 --latency-ms 30 --min-throughput 5000
+    python bench.py --sizes 1000 --rate 600 --mode continuous   # scheduler continuo vs batch
+
+Ogni dimensione gira in un sottoprocesso separato (stato e memoria puliti).
+Con --min-throughput lo script esce con codice 1 se le release/min scendono
+sotto la soglia: serve per accorgersi delle regressioni prima del deploy.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+EPOCH = datetime(2024, 1, 1)
+
+# ================== SERVER FINTO (Discogs + Telegram) ==================
+class FakeApiState:
+    """Stato condiviso dal server finto: wantlist, copie in vendita, budget, messaggi ricevuti."""
+
+    def __init__(self, size, rate, latency_ms, jitter_ms, p429, seed=42):
+        rng = random.Random(seed)
+        self.size = size
+        self.rate = rate
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.p429 = p429
+        self.rng = rng
+        self.release_ids = [1000000 + i for i in range(size)]
+        self.counts = {rid: rng.choice((0, 0, 0, 1, 2, 5)) for rid in self.release_ids}
+        self.lock = threading.Lock()
+        self.window = deque()          # timestamp delle richieste nell'ultimo minuto
+        self.requests = 0
+        self.responses_429 = 0
+        self.messages = []             # (timestamp, testo) ricevuti su sendMessage
+        self.bumped = {}               # release_id -> istante dell'aumento copie
+
+    def take_budget(self):
+        """Finestra mobile di 60s come Discogs. Ritorna (ammessa, rimaste, usate)."""
+        with self.lock:
+            now = time.time()
+            while self.window and now - self.window[0] >= 60:
+                self.window.popleft()
+            self.requests += 1
+            if len(self.window) >= self.rate or self.rng.random() < self.p429:
+                self.responses_429 += 1
+                return False, max(0, self.rate - len(self.window)), len(self.window)
+            self.window.append(now)
+            return True, self.rate - len(self.window), len(self.window)
+
+    def bump(self, release_id):
+        with self.lock:
+            self.counts[release_id] += 1
+            self.bumped[release_id] = time.time()
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive, come il vero server
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, str(value))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip("/").split("/")
+            allowed, remaining, used = state.take_budget()
+            headers = {
+                "X-Discogs-Ratelimit": state.rate,
+                "X-Discogs-Ratelimit-Remaining": remaining,
+                "X-Discogs-Ratelimit-Used": used,
+            }
+            if not allowed:
+                headers["Retry-After"] = 1
+                return self._send(429, {"message": "You are making requests too quickly."}, headers)
+
+            time.sleep(max(0.0, state.latency + state.rng.uniform(-state.jitter, state.jitter)))
+
+            if len(parts) == 3 and parts[0] == "users" and parts[2] == "wants":
+                query = parse_qs(url.query)
+                page = int(query.get("page", ["1"])[0])
+                per_page = int(query.get("per_page", ["50"])[0])
+                pages = max(1, -(-state.size // per_page))
+                # Più recenti prima: l'id più alto è l'ultimo aggiunto
+                ids = list(reversed(state.release_ids))[(page - 1) * per_page:page * per_page]
+                wants = [{
+                    "id": rid,
+                    "date_added": (EPOCH + timedelta(minutes=rid - 1000000)).isoformat(),
+                    "basic_information": {"title": f"Disco {rid}", "artists": [{"name": f"Artista {rid % 97}"}]},
+                } for rid in ids]
+                body = {"pagination": {"page": page, "pages": pages, "per_page": per_page, "items": state.size}, "wants": wants}
+                return self._send(200, body, headers)
+
+            if len(parts) == 3 and parts[0] == "marketplace" and parts[1] == "stats":
+                rid = int(parts[2])
+                count = state.counts.get(rid, 0)
+                body = {
+                    "num_for_sale": count,
+                    "lowest_price": {"value": 10 + rid % 50, "currency": "EUR"} if count else None,
+                    "blocked_from_sale": False,
+                }
+                return self._send(200, body, headers)
+
+            return self._send(404, {"message": "not found"}, headers)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if self.path.endswith("/sendMessage"):
+                with state.lock:
+                    state.messages.append((time.time(), payload.get("text", "")))
+                return self._send(200, {"ok": True, "result": {}})
+            return self._send(404, {"ok": False})
+
+    return Handler
+
+def start_fake_server(state):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ================== UN BENCHMARK (dentro il sottoprocesso) ==================
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def run_one(args):
+    state = FakeApiState(args.size, args.rate, args.latency_ms, args.jitter_ms, args.p429)
+    server = start_fake_server(state)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    workdir = tempfile.mkdtemp(prefix="discogs-bench-")
+    os.chdir(workdir)
+    os.environ.update({
+        "DISCOGS_API_BASE": base,
+        "TELEGRAM_API_BASE": base,
+        "DISCOGS_TOKEN": "bench",
+        "DISCOGS_USERNAME": "bench",
+        "TELEGRAM_TOKEN": "bench",
+        "CHAT_ID_GRUPPO": "1",
+    })
+    sys.path.insert(0, REPO_DIR)
+    import main
+
+    main.logger.setLevel("WARNING")   # i log per release falserebbero le misure
+    main.BLACKLIST_SET.clear()
+    main.rate_limiter = main.RateLimiter(per_minute=args.rate, state_file="rate_limit_state.json")
+    if args.workers:
+        main.STATS_WORKERS = args.workers
+    main.RELEASES_PER_CYCLE = args.batch
+
+    latencies = []
+    original_fetch = main.get_release_stats_stable
+
+    def timed_fetch(release_id, *a, **kw):
+        started = time.perf_counter()
+        try:
+            return original_fetch(release_id, *a, **kw)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    main.get_release_stats_stable = timed_fetch
+    tracemalloc.start()
+    result = {"size": args.size}
+
+    # --- wantlist: primo download completo, poi controllo incrementale
+    requests_before = state.requests
+    started = time.perf_counter()
+    wants = main.get_wantlist()
+    result["wantlist_full_s"] = time.perf_counter() - started
+    result["wantlist_full_requests"] = state.requests - requests_before
+    assert len(wants) == args.size, f"wantlist incompleta: {len(wants)}/{args.size}"
+
+    main.load_wantlist_snapshot()["checked_at"] = 0
+    requests_before = state.requests
+    started = time.perf_counter()
+    main.get_wantlist()
+    result["wantlist_incremental_s"] = time.perf_counter() - started
+    result["wantlist_incremental_requests"] = state.requests - requests_before
+
+    # --- cicli di monitoraggio (in continuo: lo stesso numero di release, senza confini di ciclo)
+    checked_before = len(latencies)
+    started = time.perf_counter()
+    if args.mode == "continuous":
+        threading.Thread(target=main.ContinuousScheduler(workers=args.workers or None).run, daemon=True).start()
+        while len(latencies) - checked_before < args.cycles * args.batch:
+            time.sleep(0.01)
+    else:
+        for _ in range(args.cycles):
+            main.monitor_stats_stable()
+    elapsed = time.perf_counter() - started
+    checked = len(latencies) - checked_before
+    result["cycles"] = args.cycles
+    result["releases_checked"] = checked
+    result["releases_per_min"] = checked / elapsed * 60 if elapsed else 0.0
+    result["latency_p50_ms"] = percentile(latencies, 50) * 1000
+    result["latency_p99_ms"] = percentile(latencies, 99) * 1000
+
+    # --- tempo di rilevazione: si aumentano le copie di una release già vista
+    # e si misura quando arriva il messaggio su Telegram
+    cache = main.load_stats_cache()
+    learned = [rid for rid in state.release_ids if str(rid) in cache]
+    detect = None
+    if learned:
+        target = state.rng.choice(learned)
+        state.bump(target)
+        deadline = time.time() + args.detect_timeout
+        while time.time() < deadline and detect is None:
+            if args.mode == "batch":
+                main.monitor_stats_stable()
+            wait_until = time.time() + 2
+            while time.time() < min(wait_until, deadline):
+                hits = [ts for ts, text in list(state.messages) if f"release_id={target}" in text]
+                if hits:
+                    detect = hits[0] - state.bumped[target]
+                    break
+                time.sleep(0.05)
+    result["detect_s"] = detect
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result["peak_mem_mb"] = peak / (1024 * 1024)
+    result["server_requests"] = state.requests
+    result["server_429"] = state.responses_429
+    print(json.dumps(result))
+
+# ================== ORCHESTRAZIONE ==================
+def format_row(r):
+    detect = f"{r['detect_s']:.1f}s" if r.get('detect_s') is not None else "timeout"
+    return (
+        f"{r['size']:>7} | {r['releases_per_min']:>10.0f} | {r['latency_p50_ms']:>8.1f} | {r['latency_p99_ms']:>8.1f} | "
+        f"{detect:>9} | {r['peak_mem_mb']:>8.1f} | {r['wantlist_full_s']:>6.2f}s/{r['wantlist_full_requests']:<4} | "
+        f"{r['wantlist_incremental_requests']:>4} | {r['server_429']:>4}"
+    )
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark offline del Discogs bot")
+    parser.add_argument("--sizes", default="100,1000", help="dimensioni wantlist, separate da virgola (100..50000)")
+    parser.add_argument("--cycles", type=int, default=3, help="cicli di monitor_stats_stable per dimensione (in continuo: cycles*batch release)")
+    parser.add_argument("--mode", choices=("batch", "continuous"), default="batch", help="scheduler del monitor da misurare")
+    parser.add_argument("--batch", type=int, default=100, help="RELEASES_PER_CYCLE usato nel benchmark")
+    parser.add_argument("--workers", type=int, default=0, help="STATS_WORKERS (0 = quello di main.py)")
+    parser.add_argument("--rate", type=int, default=3000, help="richieste/min ammesse dal server finto (e dal limiter)")
+    parser.add_argument("--latency-ms", type=float, default=50, help="latenza media delle risposte")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="variazione casuale della latenza")
+    parser.add_argument("--p429", type=float, default=0.0, help="probabilità di un 429 iniettato per richiesta")
+    parser.add_argument("--detect-timeout", type=float, default=120, help="secondi massimi per rilevare un aumento")
+    parser.add_argument("--min-throughput", type=float, default=0, help="esce con 1 se release/min < soglia")
+    parser.add_argument("--output", help="salva anche i risultati JSON in questo file")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)       # uso interno (sottoprocesso)
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        return run_one(args)
+
+    results = []
+    passthrough = [
+        "--mode", args.mode, "--cycles", str(args.cycles), "--batch", str(args.batch), "--workers", str(args.workers),
+        "--rate", str(args.rate), "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+        "--p429", str(args.p429), "--detect-timeout", str(args.detect_timeout),
+    ]
+    print(f"{'size':>7} | {'rel/min':>10} | {'p50 ms':>8} | {'p99 ms':>8} | {'detect':>9} | {'peak MB':>8} | "
+          f"{'wantlist':>12} | {'incr':>4} | {'429':>4}")
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-one", "--size", str(size)] + passthrough,
+            capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            print(f"❌ size {size} fallito:\n{proc.stderr[-2000:]}")
+            sys.exit(1)
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print(format_row(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.min_throughput and any(r["releases_per_min"] < args.min_throughput for r in results):
+        print(f"❌ Throughput sotto la soglia di {args.min_throughput:.0f} release/min")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
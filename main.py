@@ -1,27 +1,62 @@
 import os
+import sys
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
-import random
-from datetime import datetime, timedelta
-from flask import Flask, request
-from threading import Thread
+import atexit
+import math
+import heapq
+import bisect
+from array import array
+from datetime import datetime
+from collections import namedtuple, OrderedDict, deque, Counter
+from itertools import islice, count
+from uuid import uuid4
+from types import MappingProxyType
+from flask import Flask, Blueprint, request, Response, stream_with_context, jsonify
+from threading import Thread, Lock, Event, Condition, local, current_thread, get_ident
+from threading import enumerate as all_threads
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import logging
-from logging.handlers import RotatingFileHandler
+import sqlite3
+import html
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from queue import SimpleQueue
 
 # ================== CONFIG ==================
-CHECK_INTERVAL = 60          # pausa tra un ciclo e l'altro (secondi)
-RELEASES_PER_CYCLE = 100     # release controllate ad ogni ciclo (in rotazione, non casuali)
+CHECK_INTERVAL = 60          # pausa tra un ciclo e l'altro (secondi, solo in modalità batch)
+RELEASES_PER_CYCLE = 100     # release controllate ad ogni ciclo (scelte dallo scheduler, non casuali)
+# 'continuous': una nuova richiesta parte appena se ne libera il posto, il ritmo lo dà
+# solo il rate limit; 'batch': RELEASES_PER_CYCLE release e poi pausa di CHECK_INTERVAL
+SCHEDULER_MODE = os.environ.get("SCHEDULER_MODE", "continuous").strip().lower()
 TG_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 TG_CHAT = os.environ.get("CHAT_ID_GRUPPO")
 DISCOGS_TOKEN = os.environ.get("DISCOGS_TOKEN")
 USERNAME = os.environ.get("DISCOGS_USERNAME")
 
-SEEN_FILE = "notified_ids.json"
+SEEN_FILE = "notified_ids.json"        # formato vecchio: migrato nel DB al primo avvio
 LOG_FILE = "discogs_stats.log"
-STATS_CACHE_FILE = "stats_cache.json"
+LOG_JSON_FILE = "discogs_stats.jsonl"  # stessi eventi, un record JSON per riga
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+STATS_CACHE_FILE = "stats_cache.json"   # formato vecchio: migrato nel DB al primo avvio
+DB_FILE = "discogs_bot.db"
+WANTLIST_SNAPSHOT_FILE = "wantlist_snapshot.json"
+RATE_LIMIT_STATE_FILE = "rate_limit_state.json"
+
+# Scheduler: il budget fisso va alle release con più probabilità di essere cambiate
+MAX_STALENESS_HOURS = 24       # tetto: nessuna release resta senza controllo oltre questo limite
+SCHEDULER_PRIOR_CHANGES = 1    # finché non abbiamo dati propri si assume 1 variazione...
+SCHEDULER_PRIOR_DAYS = 30      # ...ogni 30 giorni
+RECHECK_WINDOW_HOURS = 6       # cambiate da meno di così: controllo in classe "recheck"
 
 NOTIFIED_RETENTION_DAYS = 14  # dopo quanti giorni un ID notificato può essere dimenticato
+# Finestra anti-spam: None = stesso giorno di calendario (come prima), altrimenti
+# secondi (es. 6 * 3600 = la stessa combinazione copie/prezzo non si rinotifica per 6 ore)
+NOTIFIED_DEDUP_WINDOW = None
 
 # Discogs: 60 richieste/min per client autenticati. Teniamo un margine di sicurezza
 # reale sotto quella soglia, condiviso tra TUTTE le chiamate (wantlist + stats).
@@ -128,19 +163,110 @@ BLACKLIST = [
 BLACKLIST_SET = set(BLACKLIST)
 
 # ================== VARIABILI GLOBALI ==================
-EMERGENCY_STOP = False
-CHECK_IN_PROGRESS = False  # Impedisce check multipli
+# Stop di emergenza e "check in corso" sono in control (DB), visibili a tutti i processi
+CYCLE_LOCK = Lock()        # un solo ciclo (automatico o job) alla volta, dentro il worker
+PROCESS_ROLE = None        # 'web', 'worker' o 'all' (web e monitor nello stesso processo)
 
 # ================== LOGGING ==================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3),
-        logging.StreamHandler()
-    ]
-)
+# I thread del monitor non scrivono più su file e stdout: il QueueHandler mette
+# il record in coda e un thread (QueueListener) lo formatta e lo scrive. Oltre
+# al log testuale c'è LOG_JSON_FILE, un record JSON per riga con i campi
+# strutturati passati con extra= (release_id, status, latency_ms, delta, ...),
+# leggibile da /logs?format=json. I messaggi di routine hanno una categoria
+# (extra={'category': ...}): per quelle in LOG_SAMPLING se ne tiene uno ogni N.
+# Di default non si scarta nulla: /logs?id= deve mostrare tutta la storia di una
+# release. Per alleggerire: LOG_SAMPLING='{"stable": 10}'.
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_FIELDS = ('category', 'release_id', 'account', 'status', 'latency_ms', 'count', 'delta', 'price',
+              'remaining', 'used')
+# categoria -> uno ogni N (solo INFO e DEBUG: avvisi ed errori passano sempre)
+LOG_SAMPLING = {}
+
+def load_log_sampling(raw):
+    """LOG_SAMPLING dall'env; ritorna (campionamento, errore). Un valore sbagliato non blocca l'avvio."""
+    if not raw:
+        return dict(LOG_SAMPLING), None
+    try:
+        sampling = {str(category): int(every) for category, every in json.loads(raw).items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        return dict(LOG_SAMPLING), e
+    return dict(LOG_SAMPLING, **sampling), None
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'msg': record.getMessage().strip(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class LogSampler(logging.Filter):
+    """Tiene un record ogni N per le categorie campionate."""
+
+    def __init__(self, every=LOG_SAMPLING):
+        super().__init__()
+        self.every = every
+        self._seen = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        category = getattr(record, 'category', None)
+        every = self.every.get(category)
+        if not every or every <= 1 or record.levelno > logging.INFO:
+            return True
+        with self._lock:
+            seen = self._seen.get(category, 0)
+            self._seen[category] = seen + 1
+        if seen % every == 0:
+            return True
+        metrics.inc('log_records_sampled_out_total', category=category)
+        return False
+
+class AsyncLogHandler(QueueHandler):
+    def prepare(self, record):
+        # Stesso processo: niente pickle, quindi il messaggio (formattazione pigra
+        # con %s) si costruisce nel thread di scrittura, non in quello che logga
+        return record
+
+_log_queue = SimpleQueue()
+log_listener = None
+
+def start_log_writer(to_files=True):
+    """(Ri)avvia il thread che scrive i log. to_files=False: solo stdout (processo web)."""
+    global log_listener
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers = [console]
+    if to_files:
+        text_file = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+        text_file.setFormatter(logging.Formatter(LOG_FORMAT))
+        json_file = RotatingFileHandler(LOG_JSON_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+        json_file.setFormatter(JsonLogFormatter())
+        handlers += [text_file, json_file]
+    if log_listener is not None:
+        log_listener.stop()  # scrive quello che è già in coda
+        for handler in log_listener.handlers:
+            handler.close()
+    log_listener = QueueListener(_log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+_log_sampling, _log_sampling_error = load_log_sampling(os.environ.get("LOG_SAMPLING"))
+_log_handler = AsyncLogHandler(_log_queue)
+_log_handler.addFilter(LogSampler(_log_sampling))
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
+start_log_writer()
+atexit.register(lambda: log_listener.stop())  # all'uscita si svuota la coda
 logger = logging.getLogger(__name__)
+if _log_sampling_error:
+    logger.warning(f"⚠️ LOG_SAMPLING non valido ({_log_sampling_error}), nessun campionamento")
 
 def format_minutes(seconds):
     minutes = seconds / 60
@@ -149,182 +275,1562 @@ def format_minutes(seconds):
         return f"{n} minuto" if n == 1 else f"{n} minuti"
     return f"{seconds} secondi"
 
+# ================== ACCOUNT (uno o più collezionisti) ==================
+# Un solo processo può seguire più wantlist. DISCOGS_ACCOUNTS (env, JSON) è una
+# lista di account, per esempio:
+#   [{"name": "luca", "username": "...", "discogs_token": "...",
+#     "telegram_token": "...", "chat_id": "...", "blacklist": ["123"]}]
+# I campi mancanti prendono il valore delle variabili classiche. Senza
+# DISCOGS_ACCOUNTS c'è un solo account, "default", con la BLACKLIST qui sopra;
+# con DISCOGS_ACCOUNTS la BLACKLIST si aggiunge a quella dell'account con lo
+# username di DISCOGS_USERNAME (o al primo), così chi passa a più account non
+# ricomincia a ricevere le release silenziate.
+# Le stats di una release sono uguali per tutti: una release voluta da più
+# account viene controllata una volta sola e notificata a ciascuno.
+Account = namedtuple('Account', 'name username discogs_token telegram_token chat_id blacklist')
+
+def load_accounts():
+    raw = os.environ.get("DISCOGS_ACCOUNTS")
+    if raw:
+        try:
+            accounts = []
+            for config in json.loads(raw):
+                username = config.get('username') or USERNAME
+                accounts.append(Account(
+                    name=str(config.get('name') or username),
+                    username=username,
+                    discogs_token=config.get('discogs_token') or DISCOGS_TOKEN,
+                    telegram_token=config.get('telegram_token') or TG_TOKEN,
+                    chat_id=config.get('chat_id') or TG_CHAT,
+                    blacklist=set(str(rid) for rid in config.get('blacklist', [])),
+                ))
+            if accounts:
+                legacy = next((i for i, account in enumerate(accounts) if account.username == USERNAME), 0)
+                accounts[legacy] = accounts[legacy]._replace(blacklist=accounts[legacy].blacklist | BLACKLIST_SET)
+                return accounts
+        except Exception as e:
+            logger.error(f"❌ DISCOGS_ACCOUNTS non valido, uso l'account singolo: {e}")
+    return [Account('default', USERNAME, DISCOGS_TOKEN, TG_TOKEN, TG_CHAT, BLACKLIST_SET)]
+
+ACCOUNTS = load_accounts()
+ACCOUNTS_BY_NAME = {account.name: account for account in ACCOUNTS}
+PRIMARY_ACCOUNT = ACCOUNTS[0]
+
+# ================== METRICHE (/metrics, formato Prometheus) ==================
+# Ogni thread scrive nei propri contatori (nessun lock sul percorso caldo);
+# /metrics li somma al momento della lettura. I contatori dei thread terminati
+# (es. i worker di un ciclo finito) vengono accorpati, così la lista non cresce.
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+class Metrics:
+    def __init__(self):
+        self._local = local()
+        self._shards = []            # (thread, shard)
+        self._retired = {'counters': {}, 'hist': {}}
+        self._shards_lock = Lock()
+        self._meta = {}              # nome -> (tipo, help, bucket)
+        self._gauges = {}            # nome -> funzione che ritorna il valore
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=METRICS_LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, tuple(buckets))
+
+    def gauge(self, name, help_text, fn):
+        self._meta[name] = ('gauge', help_text, None)
+        self._gauges[name] = fn
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {'counters': {}, 'hist': {}}
+            self._local.shard = shard
+            with self._shards_lock:
+                self._shards.append((current_thread(), shard))
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard()['counters']
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        hist = self._shard()['hist']
+        key = (name, tuple(sorted(labels.items())))
+        entry = hist.get(key)
+        if entry is None:
+            entry = hist[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _merge(target, shard):
+        for key, value in list(shard['counters'].items()):
+            target['counters'][key] = target['counters'].get(key, 0) + value
+        for key, (counts, total, n) in list(shard['hist'].items()):
+            entry = target['hist'].setdefault(key, [[0] * len(counts), 0.0, 0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+            entry[2] += n
+
+    def collect(self):
+        with self._shards_lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self._retired, shard)
+            self._shards = alive
+            merged = {'counters': {}, 'hist': {}}
+            self._merge(merged, self._retired)
+            for _, shard in alive:
+                self._merge(merged, shard)
+        return merged
+
+    def render(self):
+        merged = self.collect()
+        lines = []
+
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'gauge':
+                try:
+                    lines.append(f"{name} {float(self._gauges[name]())}")
+                except Exception:
+                    pass
+            elif kind == 'counter':
+                for (metric, labels), value in sorted(merged['counters'].items()):
+                    if metric == name:
+                        lines.append(f"{name}{fmt_labels(labels)} {value}")
+            else:
+                for (metric, labels), (counts, total, n) in sorted(merged['hist'].items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{fmt_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{fmt_labels(labels)} {total}")
+                    lines.append(f"{name}_count{fmt_labels(labels)} {n}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram('discogs_request_duration_seconds', 'Latenza delle richieste Discogs per endpoint')
+metrics.counter('discogs_requests_total', 'Richieste Discogs per endpoint e status (200, 429, other, error)')
+metrics.histogram('rate_limit_wait_seconds', 'Tempo bloccato in attesa del budget richieste')
+metrics.counter('sleep_seconds_total', 'Secondi passati in pause fisse, per motivo')
+metrics.histogram('cycle_stage_duration_seconds', 'Durata delle fasi del ciclo di monitoraggio', METRICS_STAGE_BUCKETS)
+metrics.histogram('telegram_send_duration_seconds', 'Latenza degli invii Telegram')
+metrics.counter('notifications_enqueued_total', 'Notifiche messe in coda')
+metrics.counter('notifications_sent_total', 'Notifiche consegnate a Telegram (anche dentro un riepilogo)')
+metrics.counter('jobs_total', 'Job in background conclusi, per tipo ed esito')
+metrics.counter('stats_cache_requests_total', 'Richieste stats per esito della cache (hit, miss, coalesced)')
+metrics.counter('log_records_sampled_out_total', 'Log di routine scartati dal campionamento, per categoria')
+metrics.counter('releases_checked_total', 'Release controllate dal monitor, per esito (ok, failed)')
+
+def fixed_sleep(seconds, reason):
+    metrics.inc('sleep_seconds_total', seconds, reason=reason)
+    with trace_span('sleep', 'sleep', reason=reason, seconds=seconds):
+        time.sleep(seconds)
+
+# ================== CLIENT HTTP (sessioni persistenti) ==================
+# Prima ogni chiamata usava requests.get/post a livello di modulo: handshake
+# TCP+TLS nuovo ad ogni richiesta e header ricostruiti ogni volta. Ora tutte
+# le chiamate verso Discogs e Telegram passano da sessioni con keep-alive e pool.
+# Sovrascrivibili da env solo per puntare a server finti (vedi bench.py)
+DISCOGS_API_BASE = os.environ.get("DISCOGS_API_BASE", "https://api.discogs.com")
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org")
+USER_AGENT = "DiscogsStatsBot/12.0-FINAL"
+
+# Timeout (connessione, lettura) per endpoint, in secondi
+HTTP_TIMEOUTS = {
+    'wantlist': (5, 30),
+    'stats': (5, 30),
+    'telegram': (5, 10),
+}
+HTTP_POOL_SIZE = 10          # connessioni keep-alive massime per host
+HTTP_CONNECT_RETRIES = 3     # retry SOLO su errori di connessione (la richiesta non è partita)
+
+class HttpClient:
+    """Sessioni HTTP condivise (keep-alive, gzip, pool) per Discogs e Telegram."""
+
+    def __init__(self, discogs_token, pool_size=HTTP_POOL_SIZE):
+        self.discogs = self._make_session(pool_size)
+        self.discogs.headers.update({
+            "Authorization": f"Discogs token={discogs_token}",
+            "Accept": "application/json",
+        })
+        self.telegram = self._make_session(pool_size)
+
+    @staticmethod
+    def _make_session(pool_size):
+        # Niente retry su read/status: un 429 o un timeout di lettura li gestisce
+        # chi chiama (la richiesta potrebbe essere già stata conteggiata da Discogs).
+        retry = Retry(
+            total=HTTP_CONNECT_RETRIES,
+            connect=HTTP_CONNECT_RETRIES,
+            read=0,
+            redirect=0,
+            status=0,
+            other=0,
+            backoff_factor=0.5,
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            "User-Agent": USER_AGENT,
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+        })
+        return session
+
+    def discogs_get(self, path, params=None, endpoint='stats'):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.discogs.get(f"{DISCOGS_API_BASE}{path}", params=params, timeout=HTTP_TIMEOUTS[endpoint])
+            status = str(response.status_code) if response.status_code in (200, 429) else 'other'
+            return response
+        finally:
+            metrics.observe('discogs_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+            metrics.inc('discogs_requests_total', endpoint=endpoint, status=status)
+
+    def telegram_post(self, method, payload, token=None):
+        url = f"{TELEGRAM_API_BASE}/bot{token or TG_TOKEN}/{method}"
+        return self.telegram.post(url, json=payload, timeout=HTTP_TIMEOUTS['telegram'])
+
+# Un client (e quindi un header Authorization) per ogni account Discogs
+account_clients = {account.name: HttpClient(account.discogs_token) for account in ACCOUNTS}
+http_client = account_clients[PRIMARY_ACCOUNT.name]
+
+def client_for(account):
+    return http_client if account is None or account is PRIMARY_ACCOUNT else account_clients[account.name]
+
 # ================== TELEGRAM ==================
-def send_telegram(msg):
-    if EMERGENCY_STOP:
+def send_telegram(msg, account=None):
+    account = account or PRIMARY_ACCOUNT
+    if control.stopped:
         logger.info(f"🚫 Notifica bloccata in emergenza")
         return False
 
-    if not TG_TOKEN or not TG_CHAT:
+    if not account.telegram_token or not account.chat_id:
         return False
 
-    url = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
+    ok, _ = post_telegram_message(account.chat_id, msg, account.telegram_token)
+    return ok
+
+def post_telegram_message(chat_id, msg, token=None):
+    """Invio diretto. Ritorna (ok, retry_after): retry_after è valorizzato sui 429 di Telegram."""
     payload = {
-        "chat_id": TG_CHAT,
+        "chat_id": chat_id,
         "text": msg,
         "parse_mode": "HTML",
         "disable_web_page_preview": False
     }
 
     try:
-        response = requests.post(url, json=payload, timeout=10)
-        return response.status_code == 200
+        with metrics.timer('telegram_send_duration_seconds'), trace_span('send_telegram', 'telegram') as span:
+            response = http_client.telegram_post("sendMessage", payload, token)
+            span['status'] = response.status_code
+        if response.status_code == 429:
+            try:
+                retry_after = response.json().get('parameters', {}).get('retry_after')
+            except ValueError:
+                retry_after = None
+            return False, retry_after or 30
+        return response.status_code == 200, None
     except Exception as e:
         logger.error(f"❌ Errore invio Telegram: {e}")
-        return False
-
-# ================== GESTIONE ID NOTIFICATI (ANTI-SPAM) ==================
-def load_notified():
+        return False, None
+
+# ================== DATABASE (SQLite in WAL) ==================
+# Prima stats_cache.json veniva riscritto tutto (indent=2) a fine ciclo e
+# riletto tutto ad ogni ciclo e ad ogni visita di / e /cache; un crash a metà
+# ciclo perdeva tutti i risultati. Ora ogni release controllata è un upsert di
+# una riga (con indici su last_check e num_for_sale per le query).
+_db_local = local()
+_db_init_lock = Lock()
+_db_initialized = False
+
+def get_db():
+    """Connessione SQLite del thread corrente (una per thread, modalità WAL)."""
+    global _db_initialized
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+        with _db_init_lock:
+            if not _db_initialized:
+                init_db(conn)
+                _db_initialized = True
+    return conn
+
+NOTIFIED_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS notified (
+        account TEXT NOT NULL,
+        release_id TEXT NOT NULL,
+        num_for_sale INTEGER NOT NULL,
+        price TEXT NOT NULL,
+        notified_at REAL NOT NULL,
+        bucket INTEGER NOT NULL,
+        PRIMARY KEY (account, release_id, num_for_sale, price)
+    )
+"""
+
+def _table_columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def init_db(conn):
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS stats_cache (
+                release_id TEXT PRIMARY KEY,
+                num_for_sale INTEGER NOT NULL DEFAULT 0,
+                last_check REAL,
+                data TEXT NOT NULL
+            )
+        """)
+        if 'updated_at' not in _table_columns(conn, 'stats_cache'):
+            conn.execute("ALTER TABLE stats_cache ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_last_check ON stats_cache(last_check)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_updated_at ON stats_cache(updated_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_num_for_sale ON stats_cache(num_for_sale)")
+        conn.execute(NOTIFIED_SCHEMA)
+        if 'account' not in _table_columns(conn, 'notified'):
+            # Prima dei multi-account la chiave non aveva l'account: si ricostruisce la tabella
+            conn.execute("ALTER TABLE notified RENAME TO notified_old")
+            conn.execute(NOTIFIED_SCHEMA)
+            conn.execute(
+                """INSERT INTO notified (account, release_id, num_for_sale, price, notified_at, bucket)
+                   SELECT ?, release_id, num_for_sale, price, notified_at, bucket FROM notified_old""",
+                (PRIMARY_ACCOUNT.name,)
+            )
+            conn.execute("DROP TABLE notified_old")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_notified_bucket ON notified(bucket)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL
+            )
+        """)
+        if 'account' not in _table_columns(conn, 'outbox'):
+            conn.execute("ALTER TABLE outbox ADD COLUMN account TEXT NOT NULL DEFAULT 'default'")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS control (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL DEFAULT '{}',
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                done INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                release_id TEXT PRIMARY KEY,
+                samples INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history_tail (
+                release_id TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                num_for_sale INTEGER NOT NULL,
+                price_cents INTEGER NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_tail_release ON history_tail(release_id, ts)")
+    migrate_json_cache(conn)
+    migrate_json_notified(conn)
+
+def migrate_json_cache(conn):
+    """Importa il vecchio stats_cache.json, una volta sola, se il DB è vuoto."""
+    if not os.path.exists(STATS_CACHE_FILE):
+        return
     try:
-        if os.path.exists(SEEN_FILE):
-            with open(SEEN_FILE, "r") as f:
-                return set(json.load(f))
+        if conn.execute("SELECT 1 FROM stats_cache LIMIT 1").fetchone():
+            return
+        with open(STATS_CACHE_FILE, "r") as f:
+            cache = json.load(f)
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO stats_cache (release_id, num_for_sale, last_check, data, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [_stats_row(rid, entry) for rid, entry in cache.items()]
+            )
+        os.replace(STATS_CACHE_FILE, STATS_CACHE_FILE + ".migrated")
+        logger.info(f"📦 Migrate {len(cache)} release da {STATS_CACHE_FILE} al database")
     except Exception as e:
-        logger.error(f"❌ Errore caricamento notified_ids: {e}")
-    return set()
-
-def prune_notified(notified_ids, days=NOTIFIED_RETENTION_DAYS):
-    """Rimuove gli ID di notifica più vecchi di N giorni, per non far crescere il file all'infinito."""
-    cutoff = datetime.now() - timedelta(days=days)
-    pruned = set()
-    for nid in notified_ids:
+        logger.error(f"❌ Errore migrazione cache JSON: {e}")
+
+# ================== STATO CONDIVISO (web e worker) ==================
+# Con il front-end web (anche più processi gunicorn) separato dal worker, i flag
+# non possono più essere variabili globali: stanno nella tabella control (nel
+# file SQLite: i processi devono stare sulla stessa macchina, vedi STARTUP). Le
+# letture hanno una piccola cache in memoria, così il loop di monitoraggio che
+# controlla lo stop ad ogni release non interroga il DB ogni volta.
+CONTROL_CACHE_SECONDS = 1.0
+
+class ControlState:
+    """Coppie chiave/valore (JSON) nel DB, lette con cache di CONTROL_CACHE_SECONDS."""
+
+    def __init__(self, max_age=CONTROL_CACHE_SECONDS):
+        self.max_age = max_age
+        self._cache = {}   # key -> (letto_a, valore)
+
+    def get(self, key, default=None):
+        cached = self._cache.get(key)
+        if cached and time.monotonic() - cached[0] < self.max_age:
+            return cached[1]
         try:
-            date_str = nid.rsplit('_', 1)[-1]
-            entry_date = datetime.strptime(date_str, '%Y%m%d')
-            if entry_date >= cutoff:
-                pruned.add(nid)
-        except Exception:
-            continue
-    removed = len(notified_ids) - len(pruned)
-    if removed > 0:
-        logger.info(f"🧹 Pulizia notified_ids: rimossi {removed} ID più vecchi di {days} giorni")
-    return pruned
-
-def save_notified(notified):
-    try:
-        with open(SEEN_FILE, "w") as f:
-            json.dump(list(notified), f, indent=2)
-    except Exception as e:
-        logger.error(f"❌ Errore salvataggio notified_ids: {e}")
+            row = get_db().execute("SELECT value FROM control WHERE key = ?", (key,)).fetchone()
+            value = json.loads(row[0]) if row else default
+        except Exception as e:
+            logger.error(f"❌ Errore lettura stato {key}: {e}")
+            return cached[1] if cached else default
+        self._cache[key] = (time.monotonic(), value)
+        return value
+
+    def set(self, key, value):
+        conn = get_db()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO control (key, value, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time())
+            )
+        self._cache[key] = (time.monotonic(), value)
+
+    @property
+    def stopped(self):
+        return bool(self.get('emergency_stop', False))
+
+    @property
+    def cycle_running(self):
+        return bool(self.get('cycle_running', False))
+
+control = ControlState()
 
 # ================== STATS CACHE ==================
+# Il monitor lavora su un dict in memoria caricato una sola volta e scritto
+# riga per riga nel DB (write-through).
+_stats_cache_mem = None
+
+def _stats_row(release_id, entry):
+    return (str(release_id), entry.get('num_for_sale', 0) or 0, entry.get('last_check'), json.dumps(entry), time.time())
+
 def load_stats_cache():
+    global _stats_cache_mem
+    if _stats_cache_mem is None:
+        try:
+            rows = get_db().execute("SELECT release_id, data FROM stats_cache").fetchall()
+            _stats_cache_mem = {rid: json.loads(data) for rid, data in rows}
+            logger.info(f"📚 Cache caricata: {len(_stats_cache_mem)} release")
+        except Exception as e:
+            logger.error(f"❌ Errore caricamento cache: {e}")
+            return {}
+    return _stats_cache_mem
+
+def upsert_release_stats(release_id, entry):
+    """Salva una sola release: il costo di scrittura dipende dai controlli, non dalla cache."""
     try:
-        if os.path.exists(STATS_CACHE_FILE):
-            with open(STATS_CACHE_FILE, "r") as f:
-                cache = json.load(f)
-                logger.info(f"📚 Cache caricata: {len(cache)} release")
-                return cache
+        conn = get_db()
+        with conn:
+            conn.execute(
+                """INSERT INTO stats_cache (release_id, num_for_sale, last_check, data, updated_at) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(release_id) DO UPDATE SET
+                       num_for_sale = excluded.num_for_sale,
+                       last_check = excluded.last_check,
+                       data = excluded.data,
+                       updated_at = excluded.updated_at""",
+                _stats_row(release_id, entry)
+            )
     except Exception as e:
-        logger.error(f"❌ Errore caricamento cache: {e}")
-    return {}
+        logger.error("❌ Errore salvataggio release (id %s): %s", release_id, e)
 
 def save_stats_cache(cache):
+    """Sostituisce TUTTA la cache (usato da /reset): per i controlli c'è upsert_release_stats."""
+    global _stats_cache_mem
     try:
-        with open(STATS_CACHE_FILE, "w") as f:
-            json.dump(cache, f, indent=2)
+        conn = get_db()
+        with conn:
+            conn.execute("DELETE FROM stats_cache")
+            conn.executemany(
+                "INSERT INTO stats_cache (release_id, num_for_sale, last_check, data, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [_stats_row(rid, entry) for rid, entry in cache.items()]
+            )
+        _stats_cache_mem = dict(cache)
         logger.info(f"💾 Cache salvata: {len(cache)} release")
     except Exception as e:
         logger.error(f"❌ Errore salvataggio cache: {e}")
 
+# ================== SNAPSHOT IN MEMORIA (per le pagine web) ==================
+# Le pagine web (compresi i ping di uptime su /) non toccano mai il disco:
+# leggono l'ultimo snapshot immutabile pubblicato dal monitor. La pubblicazione
+# è un'assegnazione atomica del riferimento, quindi chi legge non ha bisogno di
+# lock. Copiare la cache costa O(release): il monitor non ripubblica a ogni
+# release ma al massimo ogni SNAPSHOT_PUBLISH_SECONDS (e a fine ciclo).
+StatsSnapshot = namedtuple('StatsSnapshot', 'records monitored with_stats updated_at version')
+
+_snapshot = StatsSnapshot(MappingProxyType({}), 0, 0, 0.0, 0)
+SNAPSHOT_PUBLISH_SECONDS = 1.0
+_snapshot_pending = set()        # release aggiornate dopo l'ultimo snapshot
+_snapshot_pending_lock = Lock()
+
+def _has_stats(entry):
+    return bool(entry) and (entry.get('num_for_sale') or 0) > 0
+
+def publish_snapshot(stats_cache, changed_ids=None):
+    """Pubblica una copia di stats_cache. Con changed_ids gli aggregati si aggiornano in modo incrementale."""
+    global _snapshot
+    previous = _snapshot
+    records = dict(stats_cache)
+    if changed_ids is None or previous.version == 0:
+        with_stats = sum(1 for entry in records.values() if _has_stats(entry))
+    else:
+        with_stats = previous.with_stats + sum(
+            _has_stats(records.get(rid)) - _has_stats(previous.records.get(rid)) for rid in changed_ids
+        )
+    _snapshot = StatsSnapshot(MappingProxyType(records), len(records), with_stats, time.time(), previous.version + 1)
+    return _snapshot
+
+def publish_changes(stats_cache, changed_ids=(), force=False):
+    """Segna release aggiornate; ripubblica solo se lo snapshot è più vecchio di SNAPSHOT_PUBLISH_SECONDS (o con force)."""
+    with _snapshot_pending_lock:
+        _snapshot_pending.update(changed_ids)
+        if not _snapshot_pending or (not force and time.time() - _snapshot.updated_at < SNAPSHOT_PUBLISH_SECONDS):
+            return _snapshot
+        changed = tuple(_snapshot_pending)
+        _snapshot_pending.clear()
+        return publish_snapshot(stats_cache, changed)
+
+def get_snapshot():
+    """Ultimo snapshot pubblicato (al primo accesso si parte dalla cache salvata)."""
+    if PROCESS_ROLE == 'web':
+        return refresh_snapshot_from_db()
+    if _snapshot.version == 0:
+        publish_snapshot(load_stats_cache())
+    elif _snapshot_pending:
+        publish_changes(load_stats_cache())  # coda di un ciclo già finito o monitor fermo
+    return _snapshot
+
+# Nel processo web nessuno pubblica: lo snapshot si riallinea al DB scritto dal
+# worker al massimo ogni SNAPSHOT_REFRESH_SECONDS, leggendo solo le righe con
+# updated_at recente (rilettura completa solo se sono sparite righe, es. /reset).
+SNAPSHOT_REFRESH_SECONDS = 5
+SNAPSHOT_REFRESH_OVERLAP = 2.0   # secondi riletti di nuovo per le scritture concorrenti
+_snapshot_refresh_lock = Lock()
+_snapshot_refreshed_at = 0.0
+_snapshot_watermark = 0.0
+
+def refresh_snapshot_from_db():
+    global _snapshot_refreshed_at, _snapshot_watermark
+    if time.monotonic() - _snapshot_refreshed_at < SNAPSHOT_REFRESH_SECONDS and _snapshot.version:
+        return _snapshot
+    with _snapshot_refresh_lock:
+        if time.monotonic() - _snapshot_refreshed_at < SNAPSHOT_REFRESH_SECONDS and _snapshot.version:
+            return _snapshot
+        try:
+            conn = get_db()
+            count = conn.execute("SELECT COUNT(*) FROM stats_cache").fetchone()[0]
+            full = _snapshot.version == 0 or count < _snapshot.monitored
+            since = 0.0 if full else _snapshot_watermark - SNAPSHOT_REFRESH_OVERLAP
+            rows = conn.execute(
+                "SELECT release_id, data, updated_at FROM stats_cache WHERE updated_at > ?", (since,)
+            ).fetchall()
+            changed = {rid: json.loads(data) for rid, data, _ in rows}
+            if full:
+                publish_snapshot(changed)
+            elif changed:
+                records = dict(_snapshot.records)
+                records.update(changed)
+                publish_snapshot(records, changed)
+            if rows:
+                _snapshot_watermark = max(_snapshot_watermark if not full else 0.0, max(row[2] for row in rows))
+        except Exception as e:
+            logger.error(f"❌ Errore aggiornamento snapshot dal DB: {e}")
+        _snapshot_refreshed_at = time.monotonic()
+    return _snapshot
+
+# ================== GESTIONE ID NOTIFICATI (ANTI-SPAM) ==================
+# Prima era un set di stringhe "{id}_{copie}_{prezzo}_{AAAAMMGG}": ad ogni ciclo
+# rsplit + strptime su ogni voce e riscrittura di tutto il file. Ora le chiavi
+# sono (account, release, copie, prezzo) con timestamp, raggruppate per giorno: la
+# pulizia scarta interi giorni (costo proporzionale a ciò che scade) e ogni
+# notifica è una riga nel DB.
+def _day_bucket(ts):
+    return int(ts // 86400)
+
+def notification_key(release_id, count, price, account=None):
+    return ((account or PRIMARY_ACCOUNT).name, str(release_id), int(count), str(price))
+
+class NotifiedStore:
+    """Storico notifiche: `key in store` dice se è già stata notificata nella finestra anti-spam."""
+
+    def __init__(self, window=NOTIFIED_DEDUP_WINDOW):
+        self.window = window
+        self._latest = {}     # chiave -> timestamp ultima notifica
+        self._buckets = {}    # giorno -> set(chiavi notificate quel giorno)
+        self._loaded = False
+        self._lock = Lock()
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._latest)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                rows = get_db().execute("SELECT account, release_id, num_for_sale, price, notified_at FROM notified").fetchall()
+                for account, rid, copies, price, ts in rows:
+                    self._remember((account, rid, copies, price), ts)
+                logger.info(f"🛡️ Storico notifiche caricato: {len(rows)} voci")
+            except Exception as e:
+                logger.error(f"❌ Errore caricamento notified: {e}")
+            self._loaded = True
+
+    def _remember(self, key, ts):
+        old = self._latest.get(key)
+        if old is not None:
+            self._buckets.get(_day_bucket(old), set()).discard(key)
+        self._latest[key] = ts
+        self._buckets.setdefault(_day_bucket(ts), set()).add(key)
+
+    def __contains__(self, key):
+        self._ensure_loaded()
+        ts = self._latest.get(key)
+        if ts is None:
+            return False
+        if self.window is None:
+            return datetime.fromtimestamp(ts).date() == datetime.now().date()
+        return time.time() - ts < self.window
+
+    def add(self, key, ts=None):
+        self._ensure_loaded()
+        ts = ts or time.time()
+        with self._lock:
+            self._remember(key, ts)
+        try:
+            conn = get_db()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO notified (account, release_id, num_for_sale, price, notified_at, bucket) VALUES (?, ?, ?, ?, ?, ?)",
+                    key + (ts, _day_bucket(ts))
+                )
+        except Exception as e:
+            logger.error(f"❌ Errore salvataggio notified: {e}")
+
+    def prune(self, days):
+        """Scarta i giorni più vecchi di `days`. Ritorna quante chiavi sono state rimosse."""
+        self._ensure_loaded()
+        cutoff = _day_bucket(time.time() - days * 86400)
+        removed = 0
+        with self._lock:
+            for bucket in [b for b in self._buckets if b < cutoff]:
+                for key in self._buckets.pop(bucket):
+                    del self._latest[key]
+                    removed += 1
+        if removed:
+            try:
+                conn = get_db()
+                with conn:
+                    conn.execute("DELETE FROM notified WHERE bucket < ?", (cutoff,))
+            except Exception as e:
+                logger.error(f"❌ Errore pulizia notified: {e}")
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._latest.clear()
+            self._buckets.clear()
+            self._loaded = True
+        try:
+            conn = get_db()
+            with conn:
+                conn.execute("DELETE FROM notified")
+        except Exception as e:
+            logger.error(f"❌ Errore reset notified: {e}")
+
+notified_store = NotifiedStore()
+
+def migrate_json_notified(conn):
+    """Importa il vecchio notified_ids.json ("{id}_{copie}_{prezzo}_{AAAAMMGG}"), una volta sola."""
+    if not os.path.exists(SEEN_FILE):
+        return
+    try:
+        with open(SEEN_FILE, "r") as f:
+            legacy = json.load(f)
+        rows = []
+        for nid in legacy:
+            try:
+                rest, date_str = nid.rsplit('_', 1)
+                rid, count, price = rest.split('_', 2)
+                ts = datetime.strptime(date_str, '%Y%m%d').timestamp()
+                rows.append((PRIMARY_ACCOUNT.name, rid, int(count), price, ts, _day_bucket(ts)))
+            except Exception:
+                continue
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO notified (account, release_id, num_for_sale, price, notified_at, bucket) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+        os.replace(SEEN_FILE, SEEN_FILE + ".migrated")
+        logger.info(f"📦 Migrati {len(rows)} ID notificati da {SEEN_FILE} al database")
+    except Exception as e:
+        logger.error(f"❌ Errore migrazione notified_ids: {e}")
+
+def load_notified():
+    return notified_store
+
+def prune_notified(notified, days=NOTIFIED_RETENTION_DAYS):
+    """Rimuove le notifiche più vecchie di N giorni, per non far crescere lo storico all'infinito."""
+    with trace_span('prune_notified', 'save'):
+        removed = notified.prune(days)
+    if removed > 0:
+        logger.info(f"🧹 Pulizia notified_ids: rimossi {removed} ID più vecchi di {days} giorni")
+    return notified
+
+# ================== STORICO PREZZI/DISPONIBILITÀ (serie temporali) ==================
+# Un campione (timestamp, copie, prezzo) per ogni controllo. In memoria le tre
+# colonne sono array compatti; su disco ogni colonna è codificata come
+# differenze dal campione precedente in varint (zigzag), una riga per release;
+# i campioni nuovi si accodano in history_tail e confluiscono nel blob a blocchi.
+# I campioni vecchi vengono diradati: tutti per HISTORY_RAW_HOURS, poi uno
+# all'ora, poi uno al giorno, tenendo SEMPRE i punti in cui qualcosa è cambiato.
+HISTORY_RAW_HOURS = 48
+HISTORY_HOURLY_DAYS = 30
+HISTORY_RETENTION_DAYS = 180
+HISTORY_CACHE_SIZE = 500     # serie tenute in memoria (LRU), le altre si rileggono dal DB
+HISTORY_TAIL_SAMPLES = 24    # campioni accodati in history_tail prima di riscrivere il blob
+HISTORY_NO_PRICE = -1        # prezzo 'N/D'
+
+def _zigzag_varints(values, out):
+    previous = 0
+    for value in values:
+        delta = value - previous
+        previous = value
+        n = (delta << 1) ^ (delta >> 63)
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+
+def _read_zigzag_varints(data, pos, count, typecode):
+    values = array(typecode)
+    previous = 0
+    for _ in range(count):
+        n = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            n |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        previous += (n >> 1) ^ -(n & 1)
+        values.append(previous)
+    return values, pos
+
+def _price_cents(price):
+    try:
+        return int(round(float(price) * 100))
+    except (TypeError, ValueError):
+        return HISTORY_NO_PRICE
+
+class ReleaseHistory:
+    """Serie temporale di una release: tre colonne parallele ordinate per timestamp."""
+
+    def __init__(self):
+        self.ts = array('q')
+        self.counts = array('q')
+        self.prices = array('q')
+
+    def __len__(self):
+        return len(self.ts)
+
+    def append(self, ts, count, price_cents):
+        self.ts.append(int(ts))
+        self.counts.append(int(count))
+        self.prices.append(price_cents)
+
+    def range(self, start=None, end=None):
+        lo = bisect.bisect_left(self.ts, start) if start is not None else 0
+        hi = bisect.bisect_right(self.ts, end) if end is not None else len(self.ts)
+        return [
+            (self.ts[i], self.counts[i], None if self.prices[i] == HISTORY_NO_PRICE else self.prices[i] / 100)
+            for i in range(lo, hi)
+        ]
+
+    def compact(self, now):
+        """Dirada i campioni vecchi. Ritorna quanti ne ha tolti."""
+        raw_after = now - HISTORY_RAW_HOURS * 3600
+        hourly_after = now - HISTORY_HOURLY_DAYS * 86400
+        drop_before = now - HISTORY_RETENTION_DAYS * 86400
+        kept = ReleaseHistory()
+        last_bucket = None
+        for ts, copies, price in zip(self.ts, self.counts, self.prices):
+            if ts < drop_before:
+                continue
+            changed = not kept or copies != kept.counts[-1] or price != kept.prices[-1]
+            if ts >= raw_after:
+                bucket = None
+            elif ts >= hourly_after:
+                bucket = ('h', ts // 3600)
+            else:
+                bucket = ('d', ts // 86400)
+            if bucket is None or changed or bucket != last_bucket:
+                kept.append(ts, copies, price)
+            last_bucket = bucket
+        removed = len(self) - len(kept)
+        self.ts, self.counts, self.prices = kept.ts, kept.counts, kept.prices
+        return removed
+
+    def encode(self):
+        out = bytearray()
+        _zigzag_varints([len(self)], out)
+        for column in (self.ts, self.counts, self.prices):
+            _zigzag_varints(column, out)
+        return bytes(out)
+
+    @classmethod
+    def decode(cls, data):
+        history = cls()
+        (count,), pos = _read_zigzag_varints(data, 0, 1, 'q')
+        history.ts, pos = _read_zigzag_varints(data, pos, count, 'q')
+        history.counts, pos = _read_zigzag_varints(data, pos, count, 'q')
+        history.prices, pos = _read_zigzag_varints(data, pos, count, 'q')
+        return history
+
+class HistoryStore:
+    """
+    Storico per release: il blob compatto in history più i campioni recenti in
+    history_tail (una riga per controllo), LRU in memoria per le letture. Un
+    controllo costa un INSERT: il blob si rilegge, si dirada e si riscrive solo
+    ogni HISTORY_TAIL_SAMPLES campioni della release.
+    """
+
+    def __init__(self, cache_size=HISTORY_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._tail = None        # release_id -> campioni in history_tail (dal DB al primo append)
+        self._lock = Lock()
+
+    @staticmethod
+    def _load(release_id):
+        conn = get_db()
+        row = conn.execute("SELECT data FROM history WHERE release_id = ?", (release_id,)).fetchone()
+        history = ReleaseHistory.decode(row[0]) if row else ReleaseHistory()
+        tail = conn.execute(
+            "SELECT ts, num_for_sale, price_cents FROM history_tail WHERE release_id = ? ORDER BY ts", (release_id,)
+        ).fetchall()
+        for ts, copies, price_cents in tail:
+            if not len(history) or ts >= history.ts[-1]:
+                history.append(ts, copies, price_cents)
+        return history
+
+    def _get(self, release_id):
+        # Chiamato con il lock preso
+        history = self._cache.get(release_id)
+        if history is None:
+            history = self._cache[release_id] = self._load(release_id)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(release_id)
+        return history
+
+    def _tail_counts(self):
+        # Chiamato con il lock preso
+        if self._tail is None:
+            self._tail = dict(get_db().execute(
+                "SELECT release_id, COUNT(*) FROM history_tail GROUP BY release_id"
+            ).fetchall())
+        return self._tail
+
+    def append(self, release_id, ts, count, price):
+        release_id = str(release_id)
+        ts, count, price_cents = int(ts), int(count), _price_cents(price)
+        try:
+            with self._lock:
+                # Le serie in cache si aggiornano in memoria; le altre non si leggono affatto
+                history = self._cache.get(release_id)
+                if history is not None:
+                    if len(history) and ts < history.ts[-1]:
+                        return  # campione fuori ordine (es. due controlli concorrenti): si scarta
+                    history.append(ts, count, price_cents)
+                conn = get_db()
+                with conn:
+                    conn.execute(
+                        "INSERT INTO history_tail (release_id, ts, num_for_sale, price_cents) VALUES (?, ?, ?, ?)",
+                        (release_id, ts, count, price_cents)
+                    )
+                tail = self._tail_counts()
+                tail[release_id] = tail.get(release_id, 0) + 1
+                if tail[release_id] >= HISTORY_TAIL_SAMPLES:
+                    self._fold(release_id, ts)
+        except Exception as e:
+            logger.error("❌ Errore salvataggio storico (id %s): %s", release_id, e)
+
+    def _fold(self, release_id, now):
+        """Riporta la coda nel blob (diradando se serve). Chiamato con il lock preso."""
+        history = self._get(release_id)
+        if len(history) and history.ts[0] < now - HISTORY_RAW_HOURS * 3600:
+            history.compact(now)
+        conn = get_db()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO history (release_id, samples, data) VALUES (?, ?, ?)",
+                (release_id, len(history), history.encode())
+            )
+            conn.execute("DELETE FROM history_tail WHERE release_id = ?", (release_id,))
+        self._tail.pop(release_id, None)
+
+    def query(self, release_id, start=None, end=None, fresh=False):
+        """Campioni [(ts, copie, prezzo)] di una release tra start ed end (timestamp).
+
+        fresh=True legge dal DB senza cache (processo web, che non vede gli append del worker).
+        """
+        if fresh:
+            return self._load(str(release_id)).range(start, end)
+        with self._lock:
+            return self._get(str(release_id)).range(start, end)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._tail = {}
+            conn = get_db()
+            with conn:
+                conn.execute("DELETE FROM history")
+                conn.execute("DELETE FROM history_tail")
+
+history_store = HistoryStore()
+
+# ================== CODA NOTIFICHE TELEGRAM ==================
+# Prima send_telegram era chiamato dal loop di monitoraggio: fino a 10s bloccato
+# sul POST, poi 1s di pausa, e un invio fallito era semplicemente perso. Ora il
+# monitor mette il messaggio in una coda salvata nel DB e va avanti; un thread
+# dedicato lo consegna rispettando i limiti di Telegram per chat, riprova con
+# backoff, e se in coda ci sono tanti messaggi per la stessa chat li unisce in
+# un unico riepilogo.
+TELEGRAM_CHAT_INTERVAL = 3.0     # secondi minimi tra due messaggi nella stessa chat (gruppi: 20/min)
+TELEGRAM_MAX_ATTEMPTS = 8        # dopo questi tentativi il messaggio viene scartato
+TELEGRAM_RETRY_BASE = 5          # backoff: 5s, 10s, 20s, ... (max 15 minuti)
+TELEGRAM_DIGEST_THRESHOLD = 4    # da quanti messaggi in coda per una chat si manda un riepilogo
+TELEGRAM_MAX_LENGTH = 4096       # limite Telegram per messaggio
+TELEGRAM_DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+class NotificationQueue:
+    """Coda persistente di messaggi Telegram con un thread di consegna."""
+
+    def __init__(self):
+        self._wake = Event()
+        self._last_sent = {}      # (account, chat_id) -> timestamp ultimo invio
+        self._thread = None
+        self._start_lock = Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name="telegram-queue", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, msg, chat_id=None, account=None):
+        """Mette in coda un messaggio per la chat dell'account. Non blocca mai sulla rete."""
+        if control.stopped:
+            logger.info("🚫 Notifica bloccata in emergenza")
+            return False
+        account = account or PRIMARY_ACCOUNT
+        chat_id = chat_id or account.chat_id
+        if not account.telegram_token or not chat_id:
+            return False
+        try:
+            now = time.time()
+            conn = get_db()
+            with conn:
+                conn.execute(
+                    "INSERT INTO outbox (account, chat_id, text, created_at, next_attempt) VALUES (?, ?, ?, ?, ?)",
+                    (account.name, str(chat_id), msg, now, now)
+                )
+        except Exception as e:
+            logger.error("❌ Errore accodamento notifica: %s", e)
+            return False
+        metrics.inc('notifications_enqueued_total')
+        self.start()
+        self._wake.set()
+        return True
+
+    def pending(self):
+        return get_db().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def _run(self):
+        while True:
+            try:
+                timeout = self._deliver_due()
+            except Exception as e:
+                logger.error(f"❌ Errore coda Telegram: {e}")
+                timeout = 10
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def _deliver_due(self):
+        """Consegna ciò che è pronto. Ritorna quanti secondi aspettare prima del prossimo giro."""
+        if control.stopped:
+            return 5  # in stop i messaggi restano in coda
+
+        now = time.time()
+        conn = get_db()
+        rows = conn.execute(
+            "SELECT id, chat_id, text, attempts, account FROM outbox WHERE next_attempt <= ? ORDER BY id LIMIT 100",
+            (now,)
+        ).fetchall()
+
+        by_chat = {}
+        for row in rows:
+            by_chat.setdefault((row[4], row[1]), []).append(row)
+
+        next_wake = 60.0
+        for (account_name, chat_id), messages in by_chat.items():
+            chat_key = (account_name, chat_id)
+            token = ACCOUNTS_BY_NAME.get(account_name, PRIMARY_ACCOUNT).telegram_token
+            wait = self._last_sent.get(chat_key, 0) + TELEGRAM_CHAT_INTERVAL - time.time()
+            if wait > 0:
+                next_wake = min(next_wake, wait)
+                continue
+            batch = self._take_batch(messages)
+            text = batch[0][2] if len(batch) == 1 else self._digest(batch)
+
+            started = time.time()
+            ok, retry_after = post_telegram_message(chat_id, text, token)
+            self._last_sent[chat_key] = time.time()
+            ids = [row[0] for row in batch]
+            with conn:
+                if ok:
+                    conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+                    metrics.inc('notifications_sent_total', len(ids))
+                    logger.info("📨 Telegram: consegnati %s messaggi a %s in %.2fs", len(ids), chat_id, time.time() - started)
+                else:
+                    self._reschedule(conn, batch, retry_after)
+            next_wake = min(next_wake, TELEGRAM_CHAT_INTERVAL)
+
+        if len(rows) == 100:
+            return 0  # c'è altro in coda
+        upcoming = conn.execute("SELECT MIN(next_attempt) FROM outbox").fetchone()[0]
+        if upcoming is not None:
+            next_wake = min(next_wake, max(0.0, upcoming - time.time()))
+        return next_wake
+
+    def _take_batch(self, messages):
+        """Un messaggio solo, o un riepilogo di quelli che stanno in un messaggio Telegram."""
+        if len(messages) < TELEGRAM_DIGEST_THRESHOLD:
+            return messages[:1]
+        batch, length = [], 0
+        for row in messages:
+            extra = len(row[2]) + len(TELEGRAM_DIGEST_SEPARATOR)
+            if batch and length + extra > TELEGRAM_MAX_LENGTH - 100:
+                break
+            batch.append(row)
+            length += extra
+        return batch
+
+    @staticmethod
+    def _digest(batch):
+        header = f"📬 <b>{len(batch)} NOTIFICHE</b>\n\n"
+        return header + TELEGRAM_DIGEST_SEPARATOR.join(row[2] for row in batch)
+
+    @staticmethod
+    def _reschedule(conn, batch, retry_after):
+        for msg_id, chat_id, _, attempts, _ in batch:
+            attempts += 1
+            if attempts >= TELEGRAM_MAX_ATTEMPTS:
+                conn.execute("DELETE FROM outbox WHERE id = ?", (msg_id,))
+                logger.error(f"❌ Notifica {msg_id} per {chat_id} scartata dopo {attempts} tentativi")
+                continue
+            delay = retry_after or min(TELEGRAM_RETRY_BASE * 2 ** (attempts - 1), 900)
+            conn.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                (attempts, time.time() + delay, msg_id)
+            )
+        logger.warning(f"⚠️ Invio Telegram fallito, {len(batch)} messaggi riprovati più tardi")
+
+notification_queue = NotificationQueue()
+
+def enqueue_telegram(msg, chat_id=None, account=None):
+    return notification_queue.enqueue(msg, chat_id, account)
+
 # ================== RATE LIMIT CONDIVISO (wantlist + stats) ==================
 # Prima, solo le chiamate stats venivano contate: se la wantlist aveva molte
 # pagine, quelle chiamate non risultavano nel conteggio e potevano far superare
 # il budget reale. Ora TUTTE le richieste verso api.discogs.com passano da qui.
-request_timestamps = []
-
-def wait_for_rate_budget():
-    global request_timestamps
-    now = time.time()
-    request_timestamps = [ts for ts in request_timestamps if now - ts < 60]
-
-    if len(request_timestamps) >= MAX_REQUESTS_PER_MINUTE:
-        oldest = min(request_timestamps)
-        wait_time = 60 - (now - oldest)
-        if wait_time > 0:
-            logger.warning(f"⏳ Rallento per {wait_time:.1f}s (già fatte {len(request_timestamps)} richieste nell'ultimo minuto)")
-            time.sleep(wait_time)
+#
+# Token bucket protetto da lock (lo usano /check, /debug, /fix-now e il loop
+# principale da thread diversi), risincronizzato con gli header di Discogs e
+# salvato su disco: un redeploy non riparte "a budget pieno" finendo nei 429.
+#
+# Le richieste hanno una classe di priorità. Quando più classi aspettano, i token
+# si dividono in proporzione a PRIORITY_SHARES con lo stesso stride scheduling
+# dello scheduler delle release (ogni classe ha un "pass" virtuale, vince il più
+# basso): un /debug scavalca i 100 controlli del ciclo e aspetta al massimo un
+# token, un refresh della wantlist non toglie tutto il budget ai controlli stats,
+# e nessuna classe resta ferma per sempre. Se aspetta una classe sola prende
+# tutto: nessun token resta inutilizzato.
+DISCOGS_RATE_LIMIT = 60            # limite reale Discogs (finestra mobile di 60s)
+RATE_LIMIT_SAVE_INTERVAL = 10      # ogni quanti secondi (al massimo) salvare lo stato su disco
+
+PRIORITY_INTERACTIVE = 0   # /debug: qualcuno sta aspettando la pagina
+PRIORITY_RECHECK = 1       # release cambiate di recente e /fix-now: da qui partono le notifiche
+PRIORITY_BACKGROUND = 2    # rotazione normale del monitor
+PRIORITY_WANTLIST = 3      # pagine della wantlist
+PRIORITY_NAMES = ('interactive', 'recheck', 'background', 'wantlist')
+PRIORITY_SHARES = (100, 6, 3, 1)   # quote del budget quando più classi aspettano insieme
+
+class RateLimiter:
+    """Token bucket thread-safe con classi di priorità: MAX_REQUESTS_PER_MINUTE token, ricarica continua."""
+
+    def __init__(self, per_minute=MAX_REQUESTS_PER_MINUTE, state_file=RATE_LIMIT_STATE_FILE):
+        self.capacity = float(per_minute)
+        self.refill_rate = per_minute / 60.0
+        self.state_file = state_file
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.blocked_until = 0.0
+        self._last_saved = 0.0
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._waiters = []      # (priorità, seq): pochi (uno per thread), basta una scansione
+        self._seq = count()
+        self._lane_pass = [0.0] * len(PRIORITY_SHARES)
+        self._vtime = 0.0       # pass dell'ultima classe servita
+        self._load()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
+            self.updated = now
+
+    def acquire(self, priority=PRIORITY_BACKGROUND):
+        """Blocca finché non tocca a questa richiesta e c'è un token. Ritorna i secondi di attesa."""
+        started = time.time()
+        waiter = (priority, next(self._seq))
+        warned = False
+        with self._cond:
+            if not any(w[0] == priority for w in self._waiters):
+                # Una classe che torna ad aspettare non accumula credito per il tempo in cui era ferma
+                self._lane_pass[priority] = max(self._lane_pass[priority], self._vtime)
+            self._waiters.append(waiter)
+            self._cond.notify_all()  # un arrivo con il pass più basso scavalca chi sta aspettando
+            try:
+                while True:
+                    now = time.time()
+                    self._refill(now)
+                    if self._next_waiter() != waiter:
+                        self._cond.wait(5)  # ogni cambio di turno fa notify; il timeout è solo una rete
+                        continue
+                    if now < self.blocked_until:
+                        wait = self.blocked_until - now
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        self._vtime = self._lane_pass[priority]
+                        self._lane_pass[priority] += 1.0 / PRIORITY_SHARES[priority]
+                        self._maybe_save(now)
+                        return now - started
+                    else:
+                        wait = (1 - self.tokens) / self.refill_rate
+                    if wait > 2 and not warned:
+                        logger.warning("⏳ Rallento per %.1fs (budget richieste esaurito)", wait)
+                        warned = True
+                    self._cond.wait(wait)
+            finally:
+                self._waiters.remove(waiter)
+                self._cond.notify_all()
+
+    def _next_waiter(self):
+        # Chiamato con il lock preso: pass più basso, poi classe, poi ordine di arrivo
+        return min(self._waiters, key=lambda w: (self._lane_pass[w[0]], w[0], w[1]))
+
+    def update_from_response(self, response):
+        """
+        Riallinea il bucket con quello che dice Discogs. Si abbassa solo, mai si
+        alza: le richieste ancora in volo non sono incluse negli header.
+        Ritorna (remaining, used) per il log.
+        """
+        headers = response.headers
+        remaining = _int_header(headers, 'X-Discogs-Ratelimit-Remaining')
+        used = _int_header(headers, 'X-Discogs-Ratelimit-Used')
+        limit = _int_header(headers, 'X-Discogs-Ratelimit') or DISCOGS_RATE_LIMIT
+
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            if remaining is not None:
+                # Discogs conta su `limit`, noi ci teniamo sotto di (limit - capacity)
+                usable = remaining - (limit - self.capacity)
+                self.tokens = max(0.0, min(self.tokens, float(usable)))
+            if response.status_code == 429:
+                retry_after = _int_header(headers, 'Retry-After') or 60
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                self.tokens = 0.0
+                self._maybe_save(now, force=True)
+        return remaining, used
+
+    def _load(self):
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, "r") as f:
+                    state = json.load(f)
+                self.tokens = min(self.capacity, float(state.get('tokens', self.capacity)))
+                self.updated = float(state.get('updated', time.time()))
+                self.blocked_until = float(state.get('blocked_until', 0))
+                self._refill(time.time())
+                logger.info(f"⚡ Stato rate limit ripristinato: {self.tokens:.1f} token disponibili")
+        except Exception as e:
+            logger.error(f"❌ Errore caricamento stato rate limit: {e}")
 
-    request_timestamps.append(time.time())
+    def _maybe_save(self, now, force=False):
+        # Chiamato con il lock preso
+        if not force and now - self._last_saved < RATE_LIMIT_SAVE_INTERVAL:
+            return
+        self._last_saved = now
+        try:
+            with open(self.state_file, "w") as f:
+                json.dump({'tokens': self.tokens, 'updated': self.updated, 'blocked_until': self.blocked_until}, f)
+        except Exception as e:
+            logger.error(f"❌ Errore salvataggio stato rate limit: {e}")
 
-def get_wantlist():
-    """Ottieni wantlist completa"""
-    all_wants = []
-    page = 1
+def _int_header(headers, name):
+    try:
+        value = headers.get(name)
+        return int(float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+rate_limiter = RateLimiter()
+
+def wait_for_rate_budget(priority=PRIORITY_BACKGROUND):
+    with trace_span('rate_wait', 'rate_limit', lane=PRIORITY_NAMES[priority]):
+        waited = rate_limiter.acquire(priority)
+    metrics.observe('rate_limit_wait_seconds', waited, lane=PRIORITY_NAMES[priority])
+    return waited
+
+# ================== WANTLIST (sync incrementale + snapshot su disco) ==================
+# Prima la wantlist veniva riscaricata tutta ad ogni ciclo: con 5.000 articoli
+# erano 50 richieste/ciclo tolte allo stesso budget delle stats. Ora si tiene
+# uno snapshot su disco e ad ogni controllo basta la pagina 1 (più recenti
+# prima): se totale e primi articoli coincidono non è cambiato nulla, se ci
+# sono solo aggiunte in cima si fondono con lo snapshot. Il download completo
+# (pagine 2..N in parallelo) avviene solo se serve o ogni WANTLIST_FULL_REFRESH_HOURS.
+WANTLIST_CHECK_INTERVAL = 5 * 60     # sotto questo intervallo si usa lo snapshot senza richieste
+WANTLIST_FULL_REFRESH_HOURS = 6      # refresh completo periodico, anche se sembra tutto uguale
+WANTLIST_PAGE_SIZE = 100
+WANTLIST_FETCH_WORKERS = 4           # pagine scaricate in parallelo nel refresh completo
+
+_wantlist_lock = Lock()
+_wantlist_snapshots = {}     # nome account -> snapshot
+
+def _slim_want(item):
+    """Tiene solo i campi usati dal bot: lo snapshot resta piccolo."""
+    basic_info = item.get('basic_information', {})
+    return {
+        'id': item.get('id'),
+        'date_added': item.get('date_added'),
+        'basic_information': {
+            'title': basic_info.get('title', 'Sconosciuto'),
+            'artists': [{'name': a.get('name', 'Sconosciuto')} for a in basic_info.get('artists', [])[:1]],
+        },
+    }
 
-    logger.info(f"📥 Scaricamento wantlist...")
+def wantlist_snapshot_file(account):
+    if account is PRIMARY_ACCOUNT:
+        return WANTLIST_SNAPSHOT_FILE
+    root, ext = os.path.splitext(WANTLIST_SNAPSHOT_FILE)
+    return f"{root}_{account.name}{ext}"
 
-    while True:
-        wait_for_rate_budget()
+def load_wantlist_snapshot(account=None):
+    account = account or PRIMARY_ACCOUNT
+    if account.name not in _wantlist_snapshots:
+        path = wantlist_snapshot_file(account)
+        try:
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    _wantlist_snapshots[account.name] = json.load(f)
+                logger.info(f"📚 Snapshot wantlist {account.name} caricato: {len(_wantlist_snapshots[account.name]['items'])} articoli")
+        except Exception as e:
+            logger.error(f"❌ Errore caricamento snapshot wantlist: {e}")
+    return _wantlist_snapshots.get(account.name)
 
-        url = f"https://api.discogs.com/users/{USERNAME}/wants"
-        params = {'page': page, 'per_page': 100}
-        headers = {
-            "Authorization": f"Discogs token={DISCOGS_TOKEN}",
-            "User-Agent": "DiscogsStatsBot/12.0-FINAL"
-        }
+def save_wantlist_snapshot(snapshot, account=None):
+    account = account or PRIMARY_ACCOUNT
+    _wantlist_snapshots[account.name] = snapshot
+    try:
+        with trace_span('save_wantlist', 'save', account=account.name), open(wantlist_snapshot_file(account), "w") as f:
+            json.dump(snapshot, f)
+    except Exception as e:
+        logger.error(f"❌ Errore salvataggio snapshot wantlist: {e}")
 
+def fetch_wantlist_page(page, account=None, max_retries=3):
+    """Una pagina della wantlist (più recenti prima). Ritorna il JSON, o None se fallisce."""
+    account = account or PRIMARY_ACCOUNT
+    params = {'page': page, 'per_page': WANTLIST_PAGE_SIZE, 'sort': 'added', 'sort_order': 'desc'}
+    for attempt in range(max_retries):
+        wait_for_rate_budget(PRIORITY_WANTLIST)
         try:
-            response = requests.get(url, headers=headers, params=params, timeout=30)
+            with trace_span('wantlist_page', 'http', page=page, account=account.name, attempt=attempt + 1) as span:
+                response = client_for(account).discogs_get(f"/users/{account.username}/wants", params=params, endpoint='wantlist')
+                span['status'] = response.status_code
+            rate_limiter.update_from_response(response)
 
+            if response.status_code == 429:
+                logger.warning("⏳ 429 sulla wantlist (pagina %s), riprovo", page)
+                continue
             if response.status_code != 200:
-                break
+                logger.warning("⚠️ Status code inatteso %s per la pagina %s della wantlist", response.status_code, page)
+                return None
 
             data = response.json()
-            wants = data.get('wants', [])
-            if not wants:
-                break
-
-            all_wants.extend(wants)
-            logger.info(f"📄 Pagina {page}: {len(wants)} articoli")
-
-            pagination = data.get('pagination', {})
-            if page >= pagination.get('pages', 1):
-                break
-            page += 1
+            logger.info("📄 Pagina %s: %s articoli", page, len(data.get('wants', [])))
+            return data
 
         except Exception as e:
-            logger.error(f"❌ Errore wantlist: {e}")
-            break
-
-    logger.info(f"✅ Wantlist: {len(all_wants)} articoli")
-    return all_wants
+            logger.error("❌ Errore wantlist (pagina %s): %s", page, e)
+            return None
+    return None
 
-def get_release_stats_stable(release_id, max_retries=3):
+def _merge_first_page(snapshot, first_wants, total):
+    """
+    Prova ad aggiornare lo snapshot con la sola pagina 1. Ritorna la lista
+    aggiornata, o None se i cambiamenti non sono solo aggiunte in cima (serve
+    allora il download completo).
+    """
+    known_ids = {w['id'] for w in snapshot['items']}
+    new_items = [w for w in first_wants if w['id'] not in known_ids]
+    known_top = [w['id'] for w in first_wants if w['id'] in known_ids]
+
+    if total != snapshot['total'] + len(new_items):
+        return None  # rimozioni (o aggiunte fuori dalla pagina 1)
+    if new_items and len(new_items) == len(first_wants):
+        return None  # pagina 1 tutta nuova: potrebbero essercene altre dopo
+    if known_top != [w['id'] for w in snapshot['items'][:len(known_top)]]:
+        return None  # ordine diverso: non possiamo fidarci del confronto
+    newest_known = max((w.get('date_added') or '' for w in snapshot['items']), default='')
+    if any((w.get('date_added') or '') < newest_known for w in new_items):
+        return None  # aggiunta "vecchia": non è una semplice aggiunta in cima
+    return new_items + snapshot['items']
+
+def get_wantlist(force_full=False, account=None):
+    """Ottieni wantlist completa di un account (dallo snapshot se è ancora valido)"""
+    account = account or PRIMARY_ACCOUNT
+    with _wantlist_lock, trace_span('get_wantlist', 'wantlist', account=account.name):
+        snapshot = load_wantlist_snapshot(account)
+        now = time.time()
+        full_due = (
+            force_full or not snapshot
+            or now - snapshot.get('full_at', 0) >= WANTLIST_FULL_REFRESH_HOURS * 3600
+        )
+
+        if not full_due and now - snapshot.get('checked_at', 0) < WANTLIST_CHECK_INTERVAL:
+            return snapshot['items']
+
+        logger.info(f"📥 Controllo wantlist {account.username}{' (refresh completo)' if full_due else ''}...")
+        first = fetch_wantlist_page(1, account)
+        if first is None:
+            if snapshot:
+                logger.warning("⚠️ Wantlist non raggiungibile, uso l'ultimo snapshot")
+                return snapshot['items']
+            return []
+
+        first_wants = [_slim_want(w) for w in first.get('wants', [])]
+        pagination = first.get('pagination', {})
+        total = pagination.get('items', len(first_wants))
+        pages = pagination.get('pages', 1)
+
+        if not full_due:
+            merged = _merge_first_page(snapshot, first_wants, total)
+            if merged is not None:
+                added = len(merged) - len(snapshot['items'])
+                if added:
+                    logger.info(f"➕ Wantlist: {added} nuovi articoli (solo pagina 1 scaricata)")
+                save_wantlist_snapshot(dict(snapshot, items=merged, total=total, checked_at=now), account)
+                return merged
+
+        all_wants = list(first_wants)
+        complete = True
+        if pages > 1:
+            with ThreadPoolExecutor(max_workers=WANTLIST_FETCH_WORKERS, thread_name_prefix="wantlist") as pool:
+                for data in pool.map(lambda page: fetch_wantlist_page(page, account), range(2, pages + 1)):
+                    if data is None:
+                        complete = False
+                        continue
+                    all_wants.extend(_slim_want(w) for w in data.get('wants', []))
+
+        if not complete:
+            # Meglio l'ultimo snapshot completo che una wantlist a metà
+            if snapshot:
+                logger.warning("⚠️ Refresh wantlist incompleto, tengo l'ultimo snapshot")
+                return snapshot['items']
+            logger.warning(f"⚠️ Refresh wantlist incompleto: {len(all_wants)}/{total} articoli")
+            return all_wants
+
+        save_wantlist_snapshot({'items': all_wants, 'total': total, 'checked_at': now, 'full_at': now}, account)
+        logger.info(f"✅ Wantlist {account.username}: {len(all_wants)} articoli")
+        return all_wants
+
+# ================== STATS MARKETPLACE ==================
+# /debug, /fix-now e il monitor passano da una piccola cache: un risultato di
+# pochi secondi fa non costa un'altra richiesta, e chi chiede la stessa release
+# mentre una richiesta è già in volo aspetta quella invece di farne una sua.
+STATS_CACHE_TTL = 60        # secondi per cui un risultato vale ancora
+STATS_CACHE_SIZE = 2048     # release tenute in memoria (LRU)
+EMPTY_STATS = MappingProxyType({'num_for_sale': 0, 'price': 'N/D', 'currency': ''})
+
+class _Flight:
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+
+class StatsFetchCache:
+    """Cache TTL con LRU e "single flight": una sola richiesta in volo per release."""
+
+    def __init__(self, ttl=STATS_CACHE_TTL, max_size=STATS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()   # release_id -> (ottenuto_a, stats)
+        self._inflight = {}             # release_id -> _Flight
+        self._lock = Lock()
+
+    def get(self, release_id, loader, bypass=False):
+        """Stats dalla cache o da loader(); loader ritorna None se fallisce (e non si salva)."""
+        release_id = str(release_id)
+        with self._lock:
+            entry = None if bypass else self._entries.get(release_id)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(release_id)
+                metrics.inc('stats_cache_requests_total', result='hit')
+                return dict(entry[1])
+            # Una richiesta già in volo è più recente di qualsiasi valore in cache:
+            # la si aspetta anche con bypass
+            flight = self._inflight.get(release_id)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[release_id] = _Flight()
+
+        if not leader:
+            metrics.inc('stats_cache_requests_total', result='coalesced')
+            flight.done.wait()
+            return dict(flight.result) if flight.result is not None else None
+
+        metrics.inc('stats_cache_requests_total', result='miss')
+        try:
+            flight.result = loader()
+        finally:
+            with self._lock:
+                del self._inflight[release_id]
+                if flight.result is not None:
+                    self._entries[release_id] = (time.monotonic(), flight.result)
+                    self._entries.move_to_end(release_id)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+            flight.done.set()
+        return dict(flight.result) if flight.result is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+stats_fetch_cache = StatsFetchCache()
+
+def get_release_stats_stable(release_id, max_retries=3, fresh=False, priority=PRIORITY_BACKGROUND):
+    """
+    Stats di una release: dalla cache se recenti, fresh=True forza una richiesta nuova.
+    Ritorna None se la richiesta fallisce: per il monitor "0 copie" sarebbe un
+    dato vero e al controllo dopo partirebbe una notifica di copie "nuove".
+    """
+    with trace_span('get_release_stats', 'stats', release_id=release_id, lane=PRIORITY_NAMES[priority]) as span:
+        stats = stats_fetch_cache.get(
+            release_id, lambda: fetch_release_stats(release_id, max_retries, priority), bypass=fresh
+        )
+        span['ok'] = stats is not None
+    return stats
+
+def fetch_release_stats(release_id, max_retries=3, priority=PRIORITY_BACKGROUND):
     """
     ✅ VERSIONE CON RATE LIMITING DINAMICO (budget condiviso con get_wantlist)
     Autenticata: le richieste autenticate hanno un limite Discogs più alto di
     quelle anonime. Il retry sui 429 è a ciclo, non ricorsivo.
+    Ritorna None se la richiesta fallisce.
     """
     for attempt in range(max_retries):
-        wait_for_rate_budget()
-
-        url = f"https://api.discogs.com/marketplace/stats/{release_id}"
-        headers = {
-            "Authorization": f"Discogs token={DISCOGS_TOKEN}",
-            "User-Agent": "DiscogsStatsBot/12.0-FINAL"
-        }
+        wait_for_rate_budget(priority)
 
         try:
-            response = requests.get(url, headers=headers, timeout=30)
-
-            remaining = int(response.headers.get('X-Discogs-Ratelimit-Remaining', 60))
-            used = int(response.headers.get('X-Discogs-Ratelimit-Used', 0))
-            logger.info(f"   📊 Rate limit: {remaining} rimaste, {used} usate")
-
-            if remaining < 10:
-                sleep_time = 5
-                logger.warning(f"⚠️ Rate limit basso ({remaining}), aspetto {sleep_time}s extra")
-                time.sleep(sleep_time)
-            elif remaining < 20:
-                time.sleep(2)
-            else:
-                time.sleep(1)
+            started = time.perf_counter()
+            with trace_span('http_stats', 'http', release_id=release_id, attempt=attempt + 1) as span:
+                response = http_client.discogs_get(f"/marketplace/stats/{release_id}", endpoint='stats')
+                span['status'] = response.status_code
+            latency_ms = round((time.perf_counter() - started) * 1000, 1)
+
+            # Niente più pause fisse: il bucket si riallinea agli header e
+            # la prossima acquire() aspetta solo se il budget è davvero finito.
+            remaining, used = rate_limiter.update_from_response(response)
+            logger.info("   📊 Rate limit: %s rimaste, %s usate (id %s)", remaining, used, release_id, extra={
+                'category': 'rate_limit', 'release_id': release_id, 'status': response.status_code,
+                'latency_ms': latency_ms, 'remaining': remaining, 'used': used,
+            })
 
             if response.status_code == 200:
                 data = response.json()
                 if data is None:
-                    return {'num_for_sale': 0, 'price': 'N/D', 'currency': ''}
+                    return dict(EMPTY_STATS)
 
                 stats_count = data.get('num_for_sale', 0) if isinstance(data, dict) else 0
                 lowest = data.get('lowest_price', {}) if isinstance(data, dict) else {}
@@ -338,248 +1844,1628 @@ def get_release_stats_stable(release_id, max_retries=3):
                 }
 
             elif response.status_code == 429:
-                retry_after = int(response.headers.get('Retry-After', 60))
-                logger.warning(f"⏳ 429, aspetto {retry_after}s (tentativo {attempt + 1}/{max_retries})")
-                time.sleep(retry_after)
+                # L'attesa la impone il limiter (blocked_until), per TUTTI i thread
+                retry_after = _int_header(response.headers, 'Retry-After') or 60
+                trace_instant('429', 'rate_limit', release_id=release_id, retry_after=retry_after)
+                logger.warning("⏳ 429, aspetto %ss (tentativo %s/%s) (id %s)", retry_after, attempt + 1, max_retries, release_id)
                 continue
 
             else:
-                logger.warning(f"⚠️ Status code inatteso {response.status_code} per {release_id}")
+                logger.warning("⚠️ Status code inatteso %s (id %s)", response.status_code, release_id)
                 break
 
         except Exception as e:
-            logger.error(f"❌ Errore stats {release_id}: {e}")
+            logger.error("❌ Errore stats (id %s): %s", release_id, e)
             break
 
-    return {'num_for_sale': 0, 'price': 'N/D', 'currency': ''}
+    return None
+
+# ================== SCHEDULER (volatilità stimata + tetto di staleness) ==================
+# Prima si ordinava solo per last_check: una release a zero copie da due anni
+# riceveva lo stesso budget di una che ha annunci nuovi ogni settimana. Ora si
+# stima per ogni release un tasso di variazione λ (variazioni osservate / tempo
+# osservato, con un prior per quelle appena aggiunte) e ScheduleIndex distribuisce
+# i controlli in proporzione a λ, con un tetto di staleness in tempo reale.
+
+def _iso_to_ts(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def observed_changes(entry):
+    """Variazioni di copie osservate; per le voci vecchie senza contatore si usa last_change."""
+    if 'changes' in entry:
+        return entry['changes']
+    return 1 if entry.get('last_change') else 0
+
+def change_rate(entry):
+    """Tasso di variazione stimato, in variazioni al secondo."""
+    first_seen = _iso_to_ts(entry.get('first_seen'))
+    last_check = entry.get('last_check', 0)
+    observed = max(0.0, last_check - first_seen) if first_seen else 0.0
+    prior_seconds = SCHEDULER_PRIOR_DAYS * 86400
+    return (observed_changes(entry) + SCHEDULER_PRIOR_CHANGES) / (observed + prior_seconds)
+
+def stats_priority(entry):
+    """Classe nel rate limiter: le release cambiate di recente sono quelle che notificano."""
+    last_change = _iso_to_ts(entry.get('last_change')) if entry else None
+    if last_change and time.time() - last_change < RECHECK_WINDOW_HOURS * 3600:
+        return PRIORITY_RECHECK
+    return PRIORITY_BACKGROUND
+
+def revisit_stride(entry):
+    """Secondi "virtuali" tra due controlli: 1/λ, cioè il tempo atteso per una variazione."""
+    return 1.0 / change_rate(entry)
+
+class ScheduleIndex:
+    """
+    Indice di priorità persistente tra i cicli (prima si ricostruiva la lista e
+    si faceva un sort completo ad ogni ciclo). È uno heap ordinato per scadenza
+    in tempo virtuale (stride scheduling): dopo ogni controllo una release
+    viene rimessa a `sua scadenza precedente + 1/λ` (mai prima dell'istante del
+    controllo), quindi a regime ogni release è controllata con frequenza
+    proporzionale a λ. Le release alla prima scadenza partono dal tempo
+    virtuale corrente, così non passano davanti a tutte le altre. Un secondo heap per
+    last_check applica il tetto di staleness in tempo reale. Le voci superate
+    restano nello heap e vengono scartate in lettura (cancellazione pigra).
+    """
 
-# ================== ROTAZIONE (le meno controllate di recente, prima) ==================
-def select_batch(wants, stats_cache, batch_size):
+    def __init__(self, blacklist=BLACKLIST_SET):
+        self.blacklist = blacklist
+        self._lock = Lock()
+        self._items = {}         # release_id -> elemento della wantlist
+        self._due = {}           # release_id -> scadenza virtuale valida (None = mai controllata)
+        self._last_check = {}    # release_id -> last_check valido
+        self._due_heap = []      # (mai_controllata?0:1, scadenza, seq, release_id)
+        self._stale_heap = []    # (last_check, seq, release_id)
+        self._seq = 0
+        self._vtime = None       # tempo virtuale: scadenza più vicina all'ultima estrazione
+        self._wants_ref = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, release_id):
+        return release_id in self._items
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._due.clear()
+            self._last_check.clear()
+            self._due_heap = []
+            self._stale_heap = []
+            self._vtime = None
+            self._wants_ref = None
+
+    def _push(self, rid, due, last_check):
+        self._seq += 1
+        self._due[rid] = due
+        self._last_check[rid] = last_check
+        heapq.heappush(self._due_heap, (0 if due is None else 1, due or 0.0, self._seq, rid))
+        if last_check:
+            heapq.heappush(self._stale_heap, (last_check, self._seq, rid))
+
+    def _add(self, rid, item, entry):
+        self._items[rid] = item
+        if not entry or not entry.get('last_check'):
+            self._push(rid, None, 0)
+            return
+        # Scadenza salvata in cache; per le voci vecchie si stima da last_check
+        due = entry.get('next_due', entry['last_check'] + revisit_stride(entry))
+        self._push(rid, due, entry['last_check'])
+
+    def sync_wants(self, wants, stats_cache):
+        """Allinea l'indice alla wantlist: aggiunge/rimuove solo le differenze."""
+        with self._lock:
+            if wants is self._wants_ref:
+                return  # get_wantlist ha restituito lo stesso snapshot: niente da fare
+            current = {}
+            for item in wants:
+                rid = str(item.get('id'))
+                if rid not in self.blacklist:
+                    current[rid] = item
+            for rid in [rid for rid in self._items if rid not in current]:
+                del self._items[rid]
+                self._due.pop(rid, None)
+                self._last_check.pop(rid, None)
+            for rid, item in current.items():
+                if rid in self._items:
+                    self._items[rid] = item
+                else:
+                    self._add(rid, item, stats_cache.get(rid))
+            self._wants_ref = wants
+            self._maybe_compact()
+
+    def update(self, rid, entry):
+        """Dopo un controllo: rimette la release in coda. Ritorna la nuova scadenza virtuale."""
+        with self._lock:
+            if rid not in self._items:
+                return None
+            # Dalla propria scadenza, non da quella del resto del batch: altrimenti
+            # le release volatili finiscono dietro a tutte le statiche estratte con loro
+            checked = entry['last_check']
+            previous = self._due.get(rid)
+            if previous is None:
+                previous = self._vtime if self._vtime is not None else checked
+            due = max(previous, checked) + revisit_stride(entry)
+            self._push(rid, due, entry['last_check'])
+            self._maybe_compact()
+            return due
+
+    def _pop_valid(self, heap, is_valid):
+        while heap:
+            top = heapq.heappop(heap)
+            if is_valid(top):
+                return top
+        return None
+
+    def select(self, n, now=None, exclude=()):
+        """
+        Le prossime n release da controllare (saltando quelle in exclude), in
+        O(n log N). Restano nell'indice con la stessa scadenza finché update()
+        non le rimette in coda: se un controllo fallisce, verranno riproposte
+        al giro dopo.
+        """
+        now = now or time.time()
+        stale_before = now - MAX_STALENESS_HOURS * 3600
+        chosen = []
+        popped = []
+        with self._lock:
+            # 1) tetto di staleness, le più vecchie prima
+            while len(chosen) < n:
+                top = self._pop_valid(self._stale_heap, lambda e: self._last_check.get(e[2]) == e[0])
+                if top is None:
+                    break
+                popped.append(('stale', top))
+                if top[0] >= stale_before:
+                    break
+                if top[2] not in exclude:
+                    chosen.append(top[2])
+            # 2) mai controllate, poi scadenza virtuale
+            picked = set(chosen)
+            picked.update(exclude)
+            first_due = None
+            while len(chosen) < n:
+                top = self._pop_valid(self._due_heap, lambda e: e[3] in self._due and self._due[e[3]] == (e[1] if e[0] else None))
+                if top is None:
+                    break
+                popped.append(('due', top))
+                if top[3] in picked:
+                    continue
+                if top[0] and first_due is None:
+                    first_due = top[1]
+                picked.add(top[3])
+                chosen.append(top[3])
+            for kind, entry in popped:
+                heapq.heappush(self._stale_heap if kind == 'stale' else self._due_heap, entry)
+            if first_due is not None:
+                self._vtime = max(self._vtime or first_due, first_due)
+            return [self._items[rid] for rid in chosen]
+
+    def oldest_check(self):
+        """last_check più vecchio tra le release già controllate (None se nessuna)."""
+        with self._lock:
+            stale_heap = self._stale_heap
+            while stale_heap and self._last_check.get(stale_heap[0][2]) != stale_heap[0][0]:
+                heapq.heappop(stale_heap)
+            return stale_heap[0][0] if stale_heap else None
+
+    def _maybe_compact(self):
+        # Le voci superate si accumulano: ogni tanto si ricostruiscono gli heap
+        if len(self._due_heap) > 2 * len(self._items) + 1000:
+            self._due_heap = [e for e in self._due_heap if e[3] in self._due and self._due[e[3]] == (e[1] if e[0] else None)]
+            heapq.heapify(self._due_heap)
+        if len(self._stale_heap) > 2 * len(self._items) + 1000:
+            self._stale_heap = [e for e in self._stale_heap if self._last_check.get(e[2]) == e[0]]
+            heapq.heapify(self._stale_heap)
+
+# Un indice per account (ognuno con la sua blacklist)
+schedule_indexes = {account.name: ScheduleIndex(account.blacklist) for account in ACCOUNTS}
+
+def release_owners(release_id):
+    """Account che vogliono la release (e non l'hanno in blacklist)."""
+    return [account for account in ACCOUNTS if release_id in schedule_indexes[account.name]]
+
+def reschedule_release(release_id, entry):
+    """Rimette in coda la release in tutti gli indici che la contengono. Ritorna la scadenza più vicina."""
+    dues = [index.update(release_id, entry) for index in schedule_indexes.values() if release_id in index]
+    dues = [due for due in dues if due is not None]
+    return min(dues) if dues else None
+
+def select_batch(wants_by_account, stats_cache, batch_size, exclude=()):
     """
-    Sceglie le release da controllare in questo ciclo, dando priorità a quelle
-    controllate meno di recente (mai controllate = priorità massima, last_check=0).
-    Niente più campionamento casuale: nel tempo si passano in rassegna TUTTE le
-    release della wantlist. La blacklist viene esclusa PRIMA di ordinare, così
-    non occupa mai posti in batch (altrimenti, non avendo mai un last_check,
-    resterebbe sempre in cima).
+    Sceglie le release da controllare in questo ciclo. Il budget del ciclo è
+    diviso in parti uguali tra gli account (quello che un account non usa va
+    agli altri); una release voluta da più account occupa un solo posto e
+    vale per tutti. La blacklist è esclusa già all'inserimento negli indici,
+    così non occupa mai posti in batch. exclude: id da saltare (già in volo).
     """
-    candidates = [item for item in wants if str(item.get('id')) not in BLACKLIST_SET]
+    active = []
+    for account in ACCOUNTS:
+        wants = wants_by_account.get(account.name)
+        if wants is None:
+            continue
+        index = schedule_indexes[account.name]
+        index.sync_wants(wants, stats_cache)
+        if len(index):
+            active.append(index)
+
+    chosen = {}
+    skip = set(exclude)
+    while len(chosen) < batch_size and active:
+        share = max(1, (batch_size - len(chosen)) // len(active))
+        still_active = []
+        for index in active:
+            wanted = min(share, batch_size - len(chosen))
+            if wanted <= 0:
+                break
+            picked = index.select(wanted, exclude=skip)
+            for item in picked:
+                chosen[str(item.get('id'))] = item
+                skip.add(str(item.get('id')))
+            if len(picked) == wanted:
+                still_active.append(index)
+        active = still_active
+    return list(chosen.values())
+
+# ================== PROFILING (cicli del monitor) ==================
+# Quando un ciclo è lento non si vede se il tempo va in HTTP, attese del rate
+# limit, JSON della cache o log. /profile?cycles=N (o PROFILE_CYCLES all'avvio)
+# arma un profiler a campionamento per i prossimi N cicli (in modalità continua
+# non ci sono cicli: ogni profilo è una finestra di tempo, un giro o il tratto
+# di giro fino a quando lo scheduler cede CYCLE_LOCK, e nel riepilogo ha
+# scope "window"): un thread legge ogni PROFILE_INTERVAL lo stack dei thread del monitor
+# con sys._current_frames(). A differenza di cProfile vede anche i thread del
+# pool stats e non rallenta le chiamate. Ogni ciclo profilato lascia in
+# PROFILE_DIR gli stack "collapsed" (per flamegraph.pl / speedscope) e un
+# riepilogo JSON delle funzioni più presenti. Disattivato non costa nulla: a
+# inizio ciclo solo una lettura (in cache) di control.
+PROFILE_DIR = "profiles"
+PROFILE_INTERVAL = 0.005      # secondi tra due campioni
+PROFILE_KEEP = 20             # cicli profilati tenuti su disco (i più vecchi si cancellano)
+PROFILE_MAX_CYCLES = 20       # tetto per /profile?cycles=N
+# Un ciclo o una finestra possono durare molto (es. un giro fermo su richieste che falliscono): oltre questo tempo
+# il profiler smette da solo di campionare e il riepilogo viene segnato come troncato.
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "300"))
+PROFILE_TOP = 25              # righe del riepilogo
+PROFILE_THREADS = ('stats', 'wantlist', 'housekeeping', 'telegram-queue')   # oltre al thread del ciclo
+
+def _thread_group(name):
+    """stats_0, stats_1, ... -> stats: i worker dello stesso pool finiscono insieme."""
+    return name.rstrip('0123456789').rstrip('_-') or name
+
+class SamplingProfiler:
+    def __init__(self, label, cycle_thread, interval=PROFILE_INTERVAL, max_seconds=PROFILE_MAX_SECONDS, scope='cycle'):
+        self.label = label
+        self.scope = scope          # 'cycle': un ciclo intero; 'window': una finestra di tempo (modalità continua)
+        self.cycle_thread = cycle_thread
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.truncated = False
+        self.stacks = Counter()     # (thread, frame più esterno, ..., frame attivo) -> campioni
+        self.samples = 0
+        self.started_at = time.time()
+        self.duration = 0.0
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="profiler", daemon=True)
+        self._labels = {}           # code object -> "funzione (file:riga)"
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if not self.truncated:
+            self.duration = time.perf_counter() - self._started
+
+    def _frame_label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def _run(self):
+        me = get_ident()
+        deadline = self._started + self.max_seconds
+        while not self._stop.wait(self.interval):
+            if time.perf_counter() >= deadline:
+                self.truncated = True
+                self.duration = time.perf_counter() - self._started
+                logger.warning(f"⏱️ Profilo {self.label}: campionamento fermato dopo {self.max_seconds:g}s")
+                return
+            names = {thread.ident: thread.name for thread in all_threads()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, '?')
+                if ident == me or (ident != self.cycle_thread and not name.startswith(PROFILE_THREADS)):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append('cycle' if ident == self.cycle_thread else _thread_group(name))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{';'.join(stack)} {n}\n" for stack, n in self.stacks.most_common())
+
+    def summary(self, top=PROFILE_TOP):
+        """Funzioni più presenti: self = in cima allo stack, total = ovunque nello stack."""
+        self_counts, total_counts, threads = Counter(), Counter(), Counter()
+        for stack, n in self.stacks.items():
+            threads[stack[0]] += n
+            self_counts[stack[-1]] += n
+            for frame in set(stack[1:]):
+                total_counts[frame] += n
+        total = sum(threads.values()) or 1
+
+        def rows(counter):
+            return [{'function': frame, 'samples': n, 'share': round(n / total, 4)} for frame, n in counter.most_common(top)]
+
+        return {
+            'label': self.label,
+            'scope': self.scope,
+            'started_at': _iso_or_none(self.started_at),
+            'ended_at': _iso_or_none(self.started_at + self.duration),
+            'duration_seconds': round(self.duration, 3),
+            'interval_seconds': self.interval,
+            'samples': self.samples,
+            'truncated': self.truncated,
+            'threads': dict(threads.most_common()),
+            'top_self': rows(self_counts),
+            'top_total': rows(total_counts),
+        }
+
+def saved_runs(directory, suffix):
+    """Nomi (senza estensione) dei file salvati per ciclo, dal più recente: iniziano con data e ora."""
+    try:
+        names = [name[:-len(suffix)] for name in os.listdir(directory) if name.endswith(suffix)]
+    except OSError:
+        return []
+    return sorted(names, reverse=True)
+
+def remove_old_runs(directory, keep, suffixes):
+    for old in saved_runs(directory, suffixes[0])[keep:]:
+        for suffix in suffixes:
+            try:
+                os.remove(os.path.join(directory, old + suffix))
+            except OSError:
+                pass
+
+def list_profiles():
+    """Riepiloghi salvati, dal più recente."""
+    return saved_runs(PROFILE_DIR, '.json')
+
+def save_profile(profiler):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{datetime.fromtimestamp(profiler.started_at).strftime('%Y%m%d-%H%M%S-%f')[:-3]}-{profiler.label}"
+    with open(os.path.join(PROFILE_DIR, f"{name}.collapsed"), "w") as f:
+        f.write(profiler.collapsed())
+    summary = profiler.summary()
+    with open(os.path.join(PROFILE_DIR, f"{name}.json"), "w") as f:
+        json.dump(summary, f, indent=1)
+    remove_old_runs(PROFILE_DIR, PROFILE_KEEP, ('.json', '.collapsed'))
+    top = summary['top_self'][0]['function'] if summary['top_self'] else '-'
+    logger.info(f"🔬 Profilo {name}: {profiler.samples} campioni in {profiler.duration:.1f}s, in cima: {top}")
+
+class CycleProfiler:
+    """Decide quali cicli profilare: i primi PROFILE_CYCLES e quelli chiesti da /profile."""
+
+    def __init__(self, cycles=0):
+        self._remaining = cycles
+        self._active = None
+        self._lock = Lock()
+
+    def begin(self, label, scope='cycle'):
+        """
+        Ritorna il profiler avviato, o None (da passare a end()). Va chiamato dal
+        thread del ciclo: è quello che il profiler segue.
+        """
+        with self._lock:
+            if self._active is not None:
+                return None  # un ciclo alla volta (es. /check mentre un giro è profilato)
+            if not self._remaining:
+                requested = control.get('profile_request')
+                if not requested:
+                    return None
+                control.set('profile_request', None)  # presa in carico (anche da un altro processo)
+                self._remaining = requested
+            self._remaining -= 1
+            profiler = self._active = SamplingProfiler(label, get_ident(), scope=scope)
+        profiler.start()
+        return profiler
+
+    def end(self, profiler):
+        if profiler is None:
+            return
+        profiler.stop()
+        with self._lock:
+            self._active = None
+        try:
+            save_profile(profiler)
+        except Exception as e:
+            logger.error(f"❌ Errore salvataggio profilo: {e}")
+
+    @contextmanager
+    def cycle(self, label):
+        profiler = self.begin(label)
+        try:
+            yield
+        finally:
+            self.end(profiler)
+
+cycle_profiler = CycleProfiler(int(os.environ.get("PROFILE_CYCLES", 0)))
+
+# ================== TRACING (span per ciclo, formato Chrome trace) ==================
+# Con le richieste in parallelo i tempi per fase non dicono dove va il tempo
+# reale. Ogni ciclo (o giro) registra degli span (trace_span) su wantlist,
+# selezione, stats (attesa del rate limit, richiesta HTTP, 429), confronto,
+# salvataggi, Telegram, pause e pulizia; a fine ciclo diventano un file JSON in
+# formato Chrome trace-event in TRACE_DIR (si apre con ui.perfetto.dev o
+# chrome://tracing), uno per ciclo, tenendo gli ultimi TRACE_KEEP. Il tracing
+# si accende con TRACE_KEEP > 0 (di default è spento). Registrano solo il thread
+# che ha aperto il ciclo e i suoi pool (TRACE_THREADS): web, coda Telegram e
+# job non finiscono nella trace di un ciclo che non li riguarda.
+TRACE_DIR = "traces"
+TRACE_KEEP = int(os.environ.get("TRACE_KEEP", 0))    # cicli tenuti su disco (0 = tracing spento)
+TRACE_MAX_EVENTS = 50000                             # tetto per ciclo (la memoria resta limitata)
+TRACE_THREADS = ('stats', 'wantlist')                # pool del ciclo, oltre al thread che lo apre
+TRACE_ROUND_THREADS = TRACE_THREADS + ('housekeeping',)   # giri continui: anche la manutenzione
+
+class CycleTrace:
+    def __init__(self, label, threads=TRACE_THREADS):
+        self.label = label
+        self.owner = get_ident()
+        self.thread_prefixes = threads
+        self.started_at = time.time()
+        self.t0 = time.perf_counter()
+        self.events = []
+        self.threads = {}    # ident -> nome, per i metadati thread_name
+
+    def covers(self, thread):
+        return thread.ident == self.owner or thread.name.startswith(self.thread_prefixes)
+
+    def add(self, name, cat, start, end=None, args=None):
+        if len(self.events) >= TRACE_MAX_EVENTS:
+            return
+        thread = current_thread()
+        self.threads.setdefault(thread.ident, thread.name)
+        event = {'name': name, 'cat': cat, 'ts': round((start - self.t0) * 1e6, 1),
+                 'pid': os.getpid(), 'tid': thread.ident}
+        if end is None:
+            event.update(ph='i', s='t')   # evento istantaneo
+        else:
+            event.update(ph='X', dur=round((end - start) * 1e6, 1))
+        if args:
+            event['args'] = args
+        self.events.append(event)   # append su una lista: atomico, niente lock
+
+    def to_json(self):
+        meta = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident, 'args': {'name': name}}
+                for ident, name in self.threads.items()]
+        return {
+            'traceEvents': meta + self.events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'label': self.label, 'started_at': _iso_or_none(self.started_at)},
+        }
+
+class CycleTracer:
+    """Un ciclo tracciato alla volta; begin() va chiamato dal thread del ciclo."""
+
+    def __init__(self, keep=TRACE_KEEP):
+        self.keep = keep
+        self.current = None
+        self._lock = Lock()
+
+    def begin(self, label, threads=TRACE_THREADS):
+        if not self.keep:
+            return None
+        with self._lock:
+            if self.current is not None:
+                return None
+            self.current = CycleTrace(label, threads)
+            return self.current
+
+    def end(self, trace):
+        if trace is None:
+            return
+        with self._lock:
+            self.current = None
+        try:
+            save_trace(trace, self.keep)
+        except Exception as e:
+            logger.error(f"❌ Errore salvataggio trace: {e}")
+
+    @contextmanager
+    def cycle(self, label):
+        trace = self.begin(label)
+        try:
+            yield
+        finally:
+            self.end(trace)
+
+tracer = CycleTracer()
+
+@contextmanager
+def trace_span(name, cat='monitor', **args):
+    """Span del ciclo in corso. Il dict restituito accetta argomenti aggiunti durante lo span."""
+    trace = tracer.current
+    if trace is None or not trace.covers(current_thread()):
+        yield args
+        return
+    started = time.perf_counter()
+    try:
+        yield args
+    finally:
+        trace.add(name, cat, started, time.perf_counter(), args)
+
+def trace_instant(name, cat='monitor', **args):
+    trace = tracer.current
+    if trace is not None and trace.covers(current_thread()):
+        trace.add(name, cat, time.perf_counter(), args=args)
 
-    def last_check_of(item):
-        rid = str(item.get('id'))
-        return stats_cache.get(rid, {}).get('last_check', 0)
+def list_traces():
+    """Trace salvate, dalla più recente."""
+    return saved_runs(TRACE_DIR, '.json')
 
-    candidates.sort(key=last_check_of)
-    return candidates[:batch_size]
+def save_trace(trace, keep=TRACE_KEEP):
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    name = f"{datetime.fromtimestamp(trace.started_at).strftime('%Y%m%d-%H%M%S-%f')[:-3]}-{trace.label}"
+    with open(os.path.join(TRACE_DIR, f"{name}.json"), "w") as f:
+        json.dump(trace.to_json(), f)
+    remove_old_runs(TRACE_DIR, keep, ('.json',))
 
 # ================== MONITORAGGIO - VERSIONE CORRETTA CON NOTIFICHE ==================
+# Pipeline a due stadi: un pool di thread tiene più richieste /marketplace/stats
+# in volo (limitate SOLO dal rate limiter condiviso), mentre questo thread
+# confronta i risultati con stats_cache e invia le notifiche man mano che
+# arrivano. stats_cache e notified_ids vengono toccati solo da qui: niente lock.
+STATS_WORKERS = 4   # richieste stats in volo contemporaneamente
+
+def describe_want(item):
+    """Ritorna (artist, title) di un elemento della wantlist."""
+    basic_info = item.get('basic_information', {})
+    title = basic_info.get('title', 'Sconosciuto')
+    artists = basic_info.get('artists', [{}])
+    artist = artists[0].get('name', 'Sconosciuto') if artists else 'Sconosciuto'
+    return artist, title
+
+def process_release_stats(item, current, stats_cache, notified_ids, owners=None):
+    """
+    Stadio di confronto: aggiorna stats_cache con le stats appena lette e, se
+    le copie sono aumentate, notifica ogni account interessato (owners).
+    Con current None (richiesta fallita) non tocca cache, storico e notifiche.
+    Ritorna True se è partita almeno una notifica.
+    """
+    release_id = str(item.get('id'))
+    owners = owners or [PRIMARY_ACCOUNT]
+    artist, title = describe_want(item)
+
+    if current is None or current.get('num_for_sale') is None:
+        logger.error("   ❌ Stats non disponibili (id %s), salto: cache e storico invariati", release_id,
+                     extra={'category': 'failed', 'release_id': release_id})
+        return False
+
+    current_count = current['num_for_sale']
+    current_price = current['price']
+    current_currency = current['currency']
+
+    previous = stats_cache.get(release_id, {})
+    previous_count = previous.get('num_for_sale', -1)
+    previous_price = previous.get('price', 'N/D')
+    notified = False
+    fields = {
+        'release_id': release_id, 'count': current_count, 'price': current_price,
+        'delta': current_count - previous_count if previous_count != -1 else None,
+    }
+
+    # 🔴 ANTI-SPAM: stessa release con stesse copie e stesso prezzo = notifica già inviata (per account)
+    to_notify = [
+        account for account in owners
+        if notification_key(release_id, current_count, current_price, account) not in notified_ids
+    ]
+
+    # 🔴 PRIMA RILEVAZIONE - apprendimento, nessuna notifica
+    if previous_count == -1:
+        logger.info("   📝 APPRENDIMENTO: %s copie (nessuna notifica) (id %s)", current_count, release_id,
+                    extra=dict(fields, category='learning'))
+
+    # 🔴 NOTIFICHE SOLO PER AUMENTI REALI (e non già notificati)
+    elif current_count > previous_count and to_notify:
+        diff = current_count - previous_count
+        emoji = "🆕"
+        action = f"+{diff} NUOVE COPIE"
+
+        price_display = f"{current_currency} {current_price}" if current_price != 'N/D' else 'N/D'
+
+        msg = (
+            f"{emoji} <b>NUOVO ANNUNCIO RILEVATO!</b>\n\n"
+            f"🎸 <b>{artist}</b>\n"
+            f"💿 {title}\n\n"
+            f"📊 <b>{action}</b>\n"
+            f"💰 Prezzo più basso: <b>{price_display}</b>\n"
+            f"📦 Totale ora: <b>{current_count} copie</b>\n\n"
+            f"🔗 <a href='https://www.discogs.com/sell/list?release_id={release_id}'>VEDI COPIE</a>"
+        )
+
+        # In coda, non inviata qui: il monitor non aspetta mai Telegram. La coda è
+        # persistente, quindi l'ID si registra subito (niente doppioni al riavvio).
+        for account in to_notify:
+            if enqueue_telegram(msg, account=account):
+                notified = True
+                notified_ids.add(notification_key(release_id, current_count, current_price, account))
+                logger.info("   🎯 NOTIFICA IN CODA (%s): %s (id %s)", account.name, action, release_id,
+                            extra=dict(fields, category='increase', account=account.name))
+
+    # 🔴 DIMINUZIONI - nessuna notifica
+    elif current_count < previous_count:
+        logger.info("   📉 Diminuzione copie: %s → %s (nessuna notifica) (id %s)", previous_count, current_count, release_id,
+                    extra=dict(fields, category='decrease'))
+
+    # 🔴 VARIAZIONI PREZZO - nessuna notifica
+    elif current_price != previous_price:
+        logger.info("   💰 Variazione prezzo: %s → %s (nessuna notifica) (id %s)", previous_price, current_price, release_id,
+                    extra=dict(fields, category='price'))
+
+    # 🔴 STABILE
+    elif current_count > 0:
+        logger.info("   ℹ️ Stabili: %s copie (nessuna notifica) (id %s)", current_count, release_id,
+                    extra=dict(fields, category='stable'))
+
+    # AGGIORNA CACHE (SEMPRE, anche se nulla è cambiato: last_check e contatori servono allo scheduler)
+    count_changed = previous_count not in (-1, current_count)
+    stats_cache[release_id] = {
+        'num_for_sale': current_count,
+        'price': current_price,
+        'currency': current_currency,
+        'artist': artist,
+        'title': title,
+        'last_change': datetime.now().isoformat() if count_changed else previous.get('last_change'),
+        'first_seen': previous.get('first_seen', datetime.now().isoformat()),
+        'last_check': time.time(),
+        'changes': observed_changes(previous) + (1 if count_changed else 0),
+        'checks': previous.get('checks', 0) + 1,
+    }
+    next_due = reschedule_release(release_id, stats_cache[release_id])
+    if next_due is not None:
+        stats_cache[release_id]['next_due'] = next_due
+    with trace_span('save_stats', 'save', release_id=release_id):
+        upsert_release_stats(release_id, stats_cache[release_id])
+    with trace_span('save_history', 'save', release_id=release_id):
+        history_store.append(release_id, stats_cache[release_id]['last_check'], current_count, current_price)
+    with trace_span('publish_snapshot', 'save'):
+        publish_changes(stats_cache, (release_id,))
+    return notified
+
+def submit_stats(pool, item, stats_cache):
+    """Primo stadio: mette in volo la richiesta stats di una release."""
+    release_id = str(item.get('id'))
+    # fresh=True: il monitor è la rotazione stessa, un valore in cache gli farebbe
+    # perdere un cambiamento; il suo risultato però riempie la cache per /debug
+    return pool.submit(
+        get_release_stats_stable, release_id, fresh=True,
+        priority=stats_priority(stats_cache.get(release_id))
+    )
+
+def handle_stats_result(item, future, stats_cache, notified_ids, label):
+    """Secondo stadio per una richiesta conclusa. Ritorna True se è partita una notifica."""
+    try:
+        artist, title = describe_want(item)
+        logger.info("[%s] %s - %.40s... (id %s)", label, artist, title, item.get('id'),
+                    extra={'category': 'progress', 'release_id': str(item.get('id'))})
+
+        current = future.result()
+        metrics.inc('releases_checked_total', result='failed' if current is None else 'ok')
+        owners = release_owners(str(item.get('id')))
+        with trace_span('compare', release_id=str(item.get('id'))):
+            return process_release_stats(item, current, stats_cache, notified_ids, owners)
+    except Exception as e:
+        logger.error("❌ Errore release (id %s): %s", item.get('id'), e)
+        return False
+
 def monitor_stats_stable():
     """Monitoraggio - VERSIONE CORRETTA con notifiche per aumenti"""
-    global CHECK_IN_PROGRESS, EMERGENCY_STOP
+    if control.stopped:
+        logger.info("⏸️ Bot in stop, salto ciclo")
+        return 0
 
-    if CHECK_IN_PROGRESS:
+    if not CYCLE_LOCK.acquire(blocking=False):
         logger.warning("⏭️ Check già in corso, salto questo ciclo")
         return 0
 
-    if EMERGENCY_STOP:
-        logger.info("⏸️ Bot in stop, salto ciclo")
-        return 0
+    control.set('cycle_running', True)
+    try:
+        with cycle_profiler.cycle('batch'), tracer.cycle('batch'):
+            return run_monitor_cycle()
+    finally:
+        control.set('cycle_running', False)
+        CYCLE_LOCK.release()
 
-    CHECK_IN_PROGRESS = True
+def run_monitor_cycle(job=None):
+    """Un ciclo di monitoraggio. Chi chiama deve avere CYCLE_LOCK."""
     logger.info("📊 Monitoraggio (notifiche attive)...")
 
+    cycle_started = time.perf_counter()
     try:
-        wants = get_wantlist()
-        if not wants:
+        with metrics.timer('cycle_stage_duration_seconds', stage='wantlist'):
+            wants_by_account = {account.name: get_wantlist(account=account) for account in ACCOUNTS}
+        if not any(wants_by_account.values()):
             return 0
 
-        stats_cache = load_stats_cache()
-        notified_ids = load_notified()
+        with metrics.timer('cycle_stage_duration_seconds', stage='selection'):
+            stats_cache = load_stats_cache()
+            notified_ids = load_notified()
+            # 🔴🔴🔴 BLACKLIST: gli indici le escludono già per account, qui solo doppia sicurezza 🔴🔴🔴
+            with trace_span('select_batch', batch_size=RELEASES_PER_CYCLE):
+                releases_to_check = [
+                    item for item in select_batch(wants_by_account, stats_cache, RELEASES_PER_CYCLE)
+                    if item.get('id') and release_owners(str(item.get('id')))
+                ]
         changes_detected = 0
         notifications_sent = 0
+        total = len(releases_to_check)
+        if job:
+            job.progress(0, total)
+
+        logger.info(f"🔍 Controllo {total} release (più probabili a cambiare prima, {STATS_WORKERS} in parallelo)...")
+
+        stats_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=STATS_WORKERS, thread_name_prefix="stats") as pool:
+            futures = {submit_stats(pool, item, stats_cache): item for item in releases_to_check}
+
+            for i, future in enumerate(as_completed(futures)):
+                if handle_stats_result(futures[future], future, stats_cache, notified_ids, f"{i+1}/{total}"):
+                    notifications_sent += 1
+                    changes_detected += 1
+                if job:
+                    job.progress(i + 1)
+
+                if control.stopped or (job and job.cancelled):
+                    # Le richieste non ancora partite non servono più
+                    for pending in futures:
+                        pending.cancel()
+                    logger.warning("🛑 Ciclo interrotto (stop di emergenza o job annullato)")
+                    break
+
+        metrics.observe('cycle_stage_duration_seconds', time.perf_counter() - stats_started, stage='stats')
+
+        # Cache e storico notifiche sono già salvati release per release
+        with metrics.timer('cycle_stage_duration_seconds', stage='persist'):
+            notified_ids = prune_notified(notified_ids)
+            publish_changes(stats_cache, force=True)
+
+        logger.info(f"✅ Rilevati {changes_detected} AUMENTI, {notifications_sent} notifiche in coda")
+        return changes_detected
 
-        releases_to_check = select_batch(wants, stats_cache, RELEASES_PER_CYCLE)
-
-        logger.info(f"🔍 Controllo {len(releases_to_check)} release (rotazione, meno controllate prima)...")
-
-        for i, item in enumerate(releases_to_check):
-            current_count = None  # reset esplicito ad ogni iterazione, usato solo per la pausa finale
+    except Exception as e:
+        logger.error(f"❌ Errore in monitor_stats_stable: {e}")
+        return 0
+    finally:
+        metrics.observe('cycle_stage_duration_seconds', time.perf_counter() - cycle_started, stage='total')
+
+# ================== SCHEDULER CONTINUO ==================
+# In modalità batch il monitor controlla RELEASES_PER_CYCLE release e poi dorme
+# CHECK_INTERVAL: intanto il budget del rate limiter si riempie e va sprecato, e
+# a fine batch si aspetta la richiesta più lenta. In modalità continua un
+# dispatcher tiene sempre STATS_WORKERS richieste in volo: appena una finisce
+# ne parte un'altra, scelta in quel momento tra le più in scadenza, e il ritmo
+# lo dà solo il rate limiter. Il confronto resta in un solo thread (quello del
+# dispatcher), come nel batch. Wantlist e pulizia anti-spam girano in un thread
+# a parte con la loro cadenza; un "giro" è solo un conteggio di
+# RELEASES_PER_CYCLE controlli per log e metriche. Il dispatcher tiene
+# CYCLE_LOCK e lo cede ai job esclusivi (/check, /reset, /fix-now) che lo
+# chiedono: finisce le richieste in volo, lo lascia e lo riprende a job finito.
+SCHEDULER_LOOKAHEAD_PER_WORKER = 2       # release scelte per volta (per worker): l'ordine di scadenza resta fresco
+FAILED_RETRY_SECONDS = 300                # una release che fallisce non si riprova prima di così
+PRUNE_INTERVAL = 3600                     # secondi tra due pulizie dello storico notifiche
+
+def schedule_description():
+    """Come parte il monitor, per home, log e messaggio di avvio."""
+    if SCHEDULER_MODE == 'batch':
+        return f"{RELEASES_PER_CYCLE} release ogni {format_minutes(CHECK_INTERVAL)}"
+    return f"continuo, {STATS_WORKERS} richieste in volo (giri da {RELEASES_PER_CYCLE} release)"
+
+class ContinuousScheduler:
+    """Dispatcher del monitor in modalità continua (gira nel thread del main loop)."""
+
+    def __init__(self, workers=None):
+        # Letti qui e non all'import: chi cambia STATS_WORKERS (es. bench.py) deve vederlo
+        self.workers = workers or STATS_WORKERS
+        self.lookahead = SCHEDULER_LOOKAHEAD_PER_WORKER * self.workers
+        self._wants = None           # wantlist per account, sostituita in blocco dal thread di manutenzione
+        self._in_flight = {}         # future -> elemento della wantlist
+        self._pending = deque()      # già scelte, non ancora partite
+        self._failed = {}            # release_id -> quando si può riprovare
+        self._holding = False
+        self._rounds = 0
+        self._trace = None           # trace e profilo: aperti solo mentre il dispatcher tiene CYCLE_LOCK
+        self._profile = None
+        self._start_round()
+
+    def run(self):
+        Thread(target=self._housekeeping, name="housekeeping", daemon=True).start()
+        logger.info(f"🔄 Scheduler continuo: {self.workers} richieste in volo, giri da {RELEASES_PER_CYCLE} release")
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="stats") as pool:
+            while True:
+                try:
+                    if not self._acquire():
+                        continue
+                    self._fill(pool)
+                    self._collect()
+                except Exception as e:
+                    logger.error(f"❌ Errore scheduler continuo: {e}")
+                    fixed_sleep(5, 'loop_error')
+
+    def _acquire(self):
+        """True se il dispatcher può lavorare; altrimenti cede il posto e aspetta."""
+        if control.stopped or job_manager.cycle_yield.is_set():
+            self._release()
+            if control.stopped:
+                fixed_sleep(5, 'stopped')
+            else:
+                time.sleep(0.2)  # un job esclusivo sta per prendere CYCLE_LOCK
+            return False
+        if not self._holding:
+            if not CYCLE_LOCK.acquire(timeout=1):
+                return False  # job esclusivo in corso
+            self._holding = True
+            control.set('cycle_running', True)  # come un ciclo batch: home e job vedono il lock occupato
+            self._open_capture()
+        return True
+
+    def _release(self):
+        self._drain()
+        self._pending.clear()
+        if self._holding:
+            self._close_capture()
+            self._holding = False
+            control.set('cycle_running', False)
+            CYCLE_LOCK.release()
+
+    def _open_capture(self):
+        # Sempre dal thread del dispatcher, e chiusi quando cede il lock: un /check
+        # nel frattempo ha trace e profilo suoi invece di finire nel giro
+        self._trace = tracer.begin('round', TRACE_ROUND_THREADS)
+        self._profile = cycle_profiler.begin('round', scope='window')
+
+    def _close_capture(self):
+        cycle_profiler.end(self._profile)
+        tracer.end(self._trace)
+        self._trace = self._profile = None
+
+    def _fill(self, pool):
+        if self._wants is None:
+            self._wants = self._load_wants()  # primo giro: sincrono (dopo il riscaldamento è già su disco)
+        stats_cache = load_stats_cache()  # si rilegge ogni volta: un /reset la sostituisce
+        while len(self._in_flight) < self.workers:
+            if not self._pending:
+                now = time.time()
+                self._failed = {rid: until for rid, until in self._failed.items() if until > now}
+                exclude = {str(item.get('id')) for item in self._in_flight.values()}
+                exclude.update(self._failed)
+                with trace_span('select_batch', batch_size=self.lookahead):
+                    self._pending.extend(select_batch(self._wants, stats_cache, self.lookahead, exclude=exclude))
+                if not self._pending:
+                    return
+            item = self._pending.popleft()
+            if item.get('id') and release_owners(str(item.get('id'))):
+                self._in_flight[submit_stats(pool, item, stats_cache)] = item
+
+    def _collect(self):
+        if not self._in_flight:
+            fixed_sleep(5, 'idle')  # wantlist vuota o tutte in attesa di riprova
+            return
+        done, _ = wait(self._in_flight, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            self._handle(future)
+
+    def _drain(self):
+        for future in list(self._in_flight):
+            future.exception()  # aspetta la fine senza sollevare
+            self._handle(future)
+
+    def _handle(self, future):
+        item = self._in_flight.pop(future)
+        label = f"giro {self._rounds + 1}, {self._round_checked + 1}/{RELEASES_PER_CYCLE}"
+        if handle_stats_result(item, future, load_stats_cache(), load_notified(), label):
+            self._round_changes += 1
+        if future.exception() is not None or future.result() is None:
+            self._failed[str(item.get('id'))] = time.time() + FAILED_RETRY_SECONDS
+        self._round_checked += 1
+        if self._round_checked >= RELEASES_PER_CYCLE:
+            self._end_round()
+
+    def _start_round(self):
+        self._round_started = time.perf_counter()
+        self._round_checked = 0
+        self._round_changes = 0
+        if self._holding:
+            self._open_capture()
+
+    def _end_round(self):
+        self._close_capture()
+        elapsed = time.perf_counter() - self._round_started
+        self._rounds += 1
+        metrics.observe('cycle_stage_duration_seconds', elapsed, stage='round')
+        logger.info(
+            f"✅ Giro {self._rounds}: {self._round_checked} release in {elapsed:.0f}s "
+            f"({self._round_checked / elapsed * 60 if elapsed else 0:.0f}/min), {self._round_changes} AUMENTI"
+        )
+        self._start_round()
+
+    @staticmethod
+    def _load_wants():
+        with metrics.timer('cycle_stage_duration_seconds', stage='wantlist'):
+            return {account.name: get_wantlist(account=account) for account in ACCOUNTS}
+
+    def _housekeeping(self):
+        last_prune = time.time()
+        while True:
+            time.sleep(WANTLIST_CHECK_INTERVAL)
             try:
-                release_id = str(item.get('id'))
-                if not release_id:
+                if control.stopped:
                     continue
+                # Un solo assegnamento: il dispatcher vede la wantlist vecchia o quella nuova, mai a metà
+                self._wants = self._load_wants()
+                if time.time() - last_prune >= PRUNE_INTERVAL:
+                    with metrics.timer('cycle_stage_duration_seconds', stage='persist'):
+                        prune_notified(load_notified())
+                    last_prune = time.time()
+            except Exception as e:
+                logger.error(f"❌ Errore manutenzione scheduler: {e}")
+
+# ================== JOB IN BACKGROUND (/fix-now, /check, /reset, /debug) ==================
+# Prima /fix-now scaricava la wantlist e faceva 30 chiamate stats dentro la
+# richiesta HTTP (minuti, timeout del router) e /check lanciava un Thread senza
+# traccia. Ora le rotte mettono in coda un job e rispondono subito con il suo id;
+# il worker lo esegue usando lo stesso rate limiter del monitor. I job stanno
+# nella tabella jobs, così il web (anche in un altro processo) li accoda e legge
+# avanzamento, velocità ed ETA, e il worker li esegue e vede gli annullamenti.
+# I job "esclusivi" aspettano CYCLE_LOCK (mai insieme a un ciclo); quelli
+# interattivi (/debug) hanno un thread a parte e non aspettano il ciclo.
+JOB_HISTORY = 50          # job conclusi tenuti nel DB per /jobs
+JOB_POLL_INTERVAL = 0.5   # ogni quanto il worker cerca job accodati da un altro processo
+JOB_SYNC_INTERVAL = 1.0   # ogni quanto un job salva l'avanzamento e legge l'annullamento
+FIX_NOW_RELEASES = 30     # release controllate dalla procedura di recupero
+DEBUG_WAIT_SECONDS = 20   # quanto /debug aspetta il risultato prima di rimandare a /jobs/<id>
+
+JobType = namedtuple('JobType', 'run exclusive')
+JOB_COLUMNS = "id, kind, params, status, created_at, started_at, finished_at, done, total, result, error, cancel_requested"
+JOB_ACTIVE = ('queued', 'running')
+
+def _iso_or_none(ts):
+    return datetime.fromtimestamp(ts).isoformat() if ts else None
+
+def job_to_dict(row):
+    (job_id, kind, params, status, created_at, started_at, finished_at,
+     done, total, result, error, cancel_requested) = row
+    now = finished_at or time.time()
+    elapsed = now - started_at if started_at else 0.0
+    per_minute = done / elapsed * 60 if elapsed > 0 else 0.0
+    eta = None
+    if status == 'running' and per_minute > 0 and total > done:
+        eta = round((total - done) / per_minute * 60, 1)
+    return {
+        'id': job_id,
+        'kind': kind,
+        'params': json.loads(params),
+        'status': status,
+        'created_at': _iso_or_none(created_at),
+        'started_at': _iso_or_none(started_at),
+        'finished_at': _iso_or_none(finished_at),
+        'done': done,
+        'total': total,
+        'elapsed_seconds': round(elapsed, 1),
+        'releases_per_minute': round(per_minute, 1),
+        'eta_seconds': eta,
+        'cancel_requested': bool(cancel_requested),
+        'result': json.loads(result) if result else None,
+        'error': error,
+    }
 
-                # 🔴🔴🔴 CONTROLLO BLACKLIST (doppia sicurezza, select_batch già le esclude) 🔴🔴🔴
-                if release_id in BLACKLIST_SET:
+class Job:
+    """Il job visto dal worker: avanzamento e annullamento sincronizzati col DB a intervalli."""
+
+    def __init__(self, job_id, kind, params):
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.done = 0
+        self.total = 0
+        self._cancelled = False
+        self._last_sync = 0.0
+
+    @property
+    def cancelled(self):
+        if not self._cancelled:
+            self._sync()
+        return self._cancelled
+
+    def progress(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+        self._sync()
+
+    def _sync(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_sync < JOB_SYNC_INTERVAL:
+            return
+        self._last_sync = now
+        conn = get_db()
+        with conn:
+            conn.execute("UPDATE jobs SET done = ?, total = ? WHERE id = ?", (self.done, self.total, self.id))
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (self.id,)).fetchone()
+        self._cancelled = bool(row and row[0])
+
+class JobManager:
+    """Job salvati nel DB: il web li accoda, i thread del worker li eseguono in ordine."""
+
+    def __init__(self, history=JOB_HISTORY):
+        self._history = history
+        self._wake = {True: Event(), False: Event()}
+        self._threads = {}
+        self._lock = Lock()
+        self.cycle_yield = Event()   # un job esclusivo aspetta CYCLE_LOCK: lo scheduler continuo lo cede
+
+    def start(self):
+        """Solo nel worker: un thread per i job esclusivi e uno per quelli interattivi."""
+        with self._lock:
+            for exclusive, name in ((True, "jobs"), (False, "jobs-interactive")):
+                thread = self._threads.get(exclusive)
+                if thread is None or not thread.is_alive():
+                    thread = Thread(target=self._run, args=(exclusive,), name=name, daemon=True)
+                    self._threads[exclusive] = thread
+                    thread.start()
+
+    def recover(self):
+        """All'avvio del worker: un job rimasto 'running' apparteneva a un processo morto."""
+        conn = get_db()
+        with conn:
+            lost = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'worker riavviato', finished_at = ? WHERE status = 'running'",
+                (time.time(),)
+            ).rowcount
+        if lost:
+            logger.warning(f"⚠️ {lost} job interrotti dal riavvio del worker")
+
+    def submit(self, kind, params=None):
+        """Accoda un job; se uno uguale è già in attesa o in corso ritorna quello."""
+        params = json.dumps(params or {}, sort_keys=True)
+        conn = get_db()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")  # niente doppioni tra processi web diversi
+            row = conn.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs WHERE kind = ? AND params = ? AND status IN {JOB_ACTIVE} "
+                "AND cancel_requested = 0 ORDER BY created_at LIMIT 1",
+                (kind, params)
+            ).fetchone()
+            if row:
+                return job_to_dict(row), False
+            job_id = uuid4().hex[:12]
+            conn.execute(
+                "INSERT INTO jobs (id, kind, params, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, kind, params, time.time())
+            )
+        for wake in self._wake.values():
+            wake.set()
+        logger.info(f"📥 Job {kind} {job_id} in coda")
+        return self.get(job_id), True
+
+    def get(self, job_id):
+        row = get_db().execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return job_to_dict(row) if row else None
+
+    def list(self):
+        rows = get_db().execute(
+            f"SELECT {JOB_COLUMNS} FROM jobs ORDER BY created_at DESC LIMIT ?", (self._history,)
+        ).fetchall()
+        return [job_to_dict(row) for row in rows]
+
+    def cancel(self, job_id):
+        conn = get_db()
+        with conn:
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND finished_at IS NULL", (job_id,))
+            # Se non è ancora partito si chiude subito; se è in corso si ferma alla prossima release
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            )
+        job = self.get(job_id)
+        if job:
+            logger.warning(f"🛑 Annullamento richiesto per job {job['kind']} {job_id}")
+        return job
+
+    def _run(self, exclusive):
+        kinds = tuple(kind for kind, job_type in JOB_TYPES.items() if job_type.exclusive == exclusive)
+        while True:
+            try:
+                job = self._next_queued(kinds)
+                if job:
+                    self._execute(job, exclusive)
                     continue
+            except Exception as e:
+                logger.error(f"❌ Errore job: {e}")
+            self._wake[exclusive].wait(JOB_POLL_INTERVAL)
+            self._wake[exclusive].clear()
+
+    def _next_queued(self, kinds):
+        placeholders = ", ".join("?" * len(kinds))
+        row = get_db().execute(
+            f"SELECT id, kind, params FROM jobs WHERE status = 'queued' AND kind IN ({placeholders}) "
+            "ORDER BY created_at LIMIT 1",
+            kinds
+        ).fetchone()
+        return Job(row[0], row[1], json.loads(row[2])) if row else None
+
+    def _execute(self, job, exclusive):
+        if not exclusive:
+            self._run_job(job)
+            return
+        # Aspetta la fine del ciclo in corso, restando annullabile
+        self.cycle_yield.set()
+        try:
+            while not CYCLE_LOCK.acquire(timeout=1):
+                if job.cancelled:
+                    return  # cancel() l'ha già segnato come annullato
+        finally:
+            self.cycle_yield.clear()
+        control.set('cycle_running', True)
+        try:
+            self._run_job(job)
+        finally:
+            control.set('cycle_running', False)
+            CYCLE_LOCK.release()
+
+    def _run_job(self, job):
+        conn = get_db()
+        with conn:
+            claimed = conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job.id)
+            ).rowcount
+        if not claimed:
+            return  # annullato mentre aspettava
+        logger.info(f"▶️ Job {job.kind} {job.id} avviato")
+        result, error = None, None
+        try:
+            result = JOB_TYPES[job.kind].run(job)
+            status = 'cancelled' if job.cancelled else 'done'
+        except Exception as e:
+            status, error = 'failed', str(e)
+        self._finish(job, status, result, error)
+
+    def _finish(self, job, status, result, error):
+        conn = get_db()
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, done = ?, total = ?, result = ?, error = ? WHERE id = ?",
+                (status, time.time(), job.done, job.total, json.dumps(result), error, job.id)
+            )
+            conn.execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND id NOT IN "
+                "(SELECT id FROM jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?)",
+                (self._history,)
+            )
+        metrics.inc('jobs_total', kind=job.kind, status=status)
+        logger.info(f"⏹️ Job {job.kind} {job.id}: {status} ({job.done}/{job.total})")
+
+job_manager = JobManager()
+
+def wait_for_job(job_id, timeout):
+    """Per le rotte web che vogliono il risultato (es. /debug): aspetta fino a timeout secondi."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = job_manager.get(job_id)
+        if job is None or job['status'] not in JOB_ACTIVE or time.monotonic() >= deadline:
+            return job
+        time.sleep(0.2)
 
-                basic_info = item.get('basic_information', {})
-                title = basic_info.get('title', 'Sconosciuto')
-                artists = basic_info.get('artists', [{}])
-                artist = artists[0].get('name', 'Sconosciuto') if artists else 'Sconosciuto'
+def run_fix_now(job):
+    """Procedura di recupero: rimanda a ogni account lo stato delle sue prime release in vendita."""
+    logger.warning("🆘 AVVIO PROCEDURA DI RECUPERO EMERGENZA!")
+    # Una release voluta da più account si legge una volta (cache stats) e si manda a ciascuno
+    wants = [
+        (account, item) for account in ACCOUNTS
+        for item in get_wantlist(account=account)[:FIX_NOW_RELEASES]
+        if str(item.get('id')) not in account.blacklist
+    ]
+    job.progress(0, len(wants))
+    recovered = 0
 
-                logger.info(f"[{i+1}/{len(releases_to_check)}] {artist} - {title[:40]}...")
+    for i, (account, item) in enumerate(wants):
+        if job.cancelled or control.stopped:
+            break
+        try:
+            release_id = str(item.get('id'))
+            artist, title = describe_want(item)
 
-                # Ottieni stats correnti
-                current = get_release_stats_stable(release_id)
+            stats = get_release_stats_stable(release_id, priority=PRIORITY_RECHECK)
 
-                if current is None or current.get('num_for_sale') is None:
-                    logger.error(f"   ❌ current è None per {release_id}, salto...")
-                    continue
+            if stats and stats['num_for_sale'] > 0:
+                msg = (
+                    f"🆘 <b>RECUPERO EMERGENZA</b>\n\n"
+                    f"🎸 <b>{artist}</b>\n"
+                    f"💿 {title}\n\n"
+                    f"📦 <b>{stats['num_for_sale']} copie in vendita!</b>\n"
+                    f"💰 Prezzo più basso: {stats['currency']} {stats['price']}\n\n"
+                    f"🔗 <a href='https://www.discogs.com/sell/list?release_id={release_id}'>VERIFICA SU DISCOGS</a>"
+                )
+                if enqueue_telegram(msg, account=account):
+                    recovered += 1
+                    logger.info(f"✅ Recuperata ({account.name}): {artist} - {title[:30]}...")
 
-                current_count = current['num_for_sale']
-                current_price = current['price']
-                current_currency = current['currency']
-
-                previous = stats_cache.get(release_id, {})
-                previous_count = previous.get('num_for_sale', -1)
-                previous_price = previous.get('price', 'N/D')
-
-                # 🔴 ANTI-SPAM: genera ID univoco per evitare notifiche doppie
-                notification_id = f"{release_id}_{current_count}_{current_price}_{datetime.now().strftime('%Y%m%d')}"
-
-                # 🔴 PRIMA RILEVAZIONE - apprendimento, nessuna notifica
-                if previous_count == -1:
-                    logger.info(f"   📝 APPRENDIMENTO: {current_count} copie (nessuna notifica)")
-
-                # 🔴 NOTIFICHE SOLO PER AUMENTI REALI (e non già notificati)
-                elif current_count > previous_count and notification_id not in notified_ids:
-                    diff = current_count - previous_count
-                    emoji = "🆕"
-                    action = f"+{diff} NUOVE COPIE"
-
-                    price_display = f"{current_currency} {current_price}" if current_price != 'N/D' else 'N/D'
-
-                    msg = (
-                        f"{emoji} <b>NUOVO ANNUNCIO RILEVATO!</b>\n\n"
-                        f"🎸 <b>{artist}</b>\n"
-                        f"💿 {title}\n\n"
-                        f"📊 <b>{action}</b>\n"
-                        f"💰 Prezzo più basso: <b>{price_display}</b>\n"
-                        f"📦 Totale ora: <b>{current_count} copie</b>\n\n"
-                        f"🔗 <a href='https://www.discogs.com/sell/list?release_id={release_id}'>VEDI COPIE</a>"
-                    )
+        except Exception as e:
+            logger.error(f"❌ Errore recupero: {e}")
+        job.progress(i + 1)
 
-                    if send_telegram(msg):
-                        notifications_sent += 1
-                        changes_detected += 1
-                        notified_ids.add(notification_id)
-                        logger.info(f"   🎯 NOTIFICA INVIATA: {action}")
-                        time.sleep(1)
-
-                # 🔴 DIMINUZIONI - nessuna notifica
-                elif current_count < previous_count:
-                    logger.info(f"   📉 Diminuzione copie: {previous_count} → {current_count} (nessuna notifica)")
-
-                # 🔴 VARIAZIONI PREZZO - nessuna notifica
-                elif current_price != previous_price:
-                    logger.info(f"   💰 Variazione prezzo: {previous_price} → {current_price} (nessuna notifica)")
-
-                # 🔴 STABILE
-                elif current_count > 0:
-                    logger.info(f"   ℹ️ Stabili: {current_count} copie (nessuna notifica)")
-
-                # AGGIORNA CACHE (SEMPRE, anche se nulla è cambiato: serve last_check per la rotazione)
-                stats_cache[release_id] = {
-                    'num_for_sale': current_count,
-                    'price': current_price,
-                    'currency': current_currency,
-                    'artist': artist,
-                    'title': title,
-                    'last_change': datetime.now().isoformat() if previous_count not in (-1, current_count) else previous.get('last_change'),
-                    'first_seen': previous.get('first_seen', datetime.now().isoformat()),
-                    'last_check': time.time()
-                }
+    return {'recovered': recovered}
 
-            except Exception as e:
-                logger.error(f"❌ Errore release {i+1}: {e}")
+def run_check(job):
+    with cycle_profiler.cycle('check'), tracer.cycle('check'):
+        return {'changes': run_monitor_cycle(job)}
 
-            # Pausa dinamica
-            if current_count is not None and current_count > 0:
-                time.sleep(random.uniform(0.8, 1.2))
-            else:
-                time.sleep(random.uniform(0.3, 0.6))
+def run_reset(job):
+    """Cache, storico notifiche e indici vivono nella memoria del worker: il reset si fa qui."""
+    save_stats_cache({})
+    publish_snapshot({})
+    stats_fetch_cache.clear()
+    notified_store.clear()
+    for index in schedule_indexes.values():
+        index.clear()
+    logger.warning("🔄 CACHE E STORICO NOTIFICHE RESETTATI!")
+    return {'reset': True}
 
-        notified_ids = prune_notified(notified_ids)
-        save_stats_cache(stats_cache)
-        save_notified(notified_ids)
+def run_debug(job):
+    stats = get_release_stats_stable(
+        str(job.params['release_id']), fresh=job.params.get('fresh', False), priority=PRIORITY_INTERACTIVE
+    )
+    return stats if stats is not None else dict(EMPTY_STATS)
+
+JOB_TYPES = {
+    'check': JobType(run_check, exclusive=True),
+    'fix-now': JobType(run_fix_now, exclusive=True),
+    'reset': JobType(run_reset, exclusive=True),
+    'debug': JobType(run_debug, exclusive=False),
+}
+
+# ================== ANALYTICS (/analytics, colonne su array) ==================
+# /cache mostra 20 voci e la home due contatori. /analytics ricava dallo
+# snapshot una vista a colonne (un array compatto per campo, la riga i è la
+# stessa release in tutti) e calcola gli aggregati con passate sugli array
+# interi: prezzi per valuta, release più movimentate, release ferme da troppo,
+# copertura della rotazione. Colonne e risultati restano validi finché lo
+# snapshot non cambia versione (cioè fino alla prossima modifica della cache).
+ANALYTICS_TOP = 20                 # release nelle classifiche (parametro top, max ANALYTICS_TOP_MAX)
+ANALYTICS_TOP_MAX = 200
+ANALYTICS_AGE_BUCKETS = (3600, 6 * 3600, 24 * 3600, 7 * 86400)   # soglie (s) per l'età dell'ultimo controllo
+ANALYTICS_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9, 0.99)
+ANALYTICS_CACHED_QUERIES = 32      # combinazioni di parametri tenute per la stessa versione
+
+class StatsColumns:
+    """stats_cache a colonne, costruita una volta per versione dello snapshot."""
+
+    def __init__(self, snapshot):
+        self.version = snapshot.version
+        self.records = snapshot.records
+        self.ids = []                    # chiavi di stats_cache, nello stesso ordine delle colonne
+        self.counts = array('l')         # copie in vendita
+        self.prices = array('d')         # prezzo più basso (nan se N/D)
+        self.currency = array('H')       # indice in self.currencies
+        self.last_change = array('d')    # timestamp (0 se mai cambiata)
+        self.last_check = array('d')     # timestamp (0 se mai controllata)
+        self.changes = array('l')
+        self.checks = array('l')
+        self.currencies = []
+        codes = {}
+        for rid, entry in snapshot.records.items():
+            self.ids.append(rid)
+            self.counts.append(entry.get('num_for_sale') or 0)
+            try:
+                self.prices.append(float(entry.get('price')))
+            except (TypeError, ValueError):
+                self.prices.append(math.nan)
+            currency = entry.get('currency') or ''
+            if currency not in codes:
+                codes[currency] = len(self.currencies)
+                self.currencies.append(currency)
+            self.currency.append(codes[currency])
+            self.last_change.append(_iso_to_ts(entry.get('last_change')) or 0.0)
+            self.last_check.append(entry.get('last_check') or 0.0)
+            self.changes.append(observed_changes(entry))
+            self.checks.append(entry.get('checks') or 0)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, i):
+        entry = self.records.get(self.ids[i], {})
+        return {
+            'release_id': self.ids[i],
+            'artist': entry.get('artist'),
+            'title': entry.get('title'),
+            'num_for_sale': self.counts[i],
+            'price': None if math.isnan(self.prices[i]) else self.prices[i],
+            'currency': self.currencies[self.currency[i]] or None,
+            'changes': self.changes[i],
+            'checks': self.checks[i],
+            'last_change': _iso_or_none(self.last_change[i] or None),
+            'last_check': _iso_or_none(self.last_check[i] or None),
+        }
 
-        logger.info(f"✅ Rilevati {changes_detected} AUMENTI, {notifications_sent} notifiche inviate")
-        return changes_detected
+def _quantiles(sorted_values):
+    n = len(sorted_values)
+    return {f"p{round(q * 100)}": sorted_values[min(n - 1, int(q * n))] for q in ANALYTICS_QUANTILES}
+
+def price_distribution(columns):
+    """Per valuta: quante release hanno un prezzo, min/max/media e quantili."""
+    by_currency = {}
+    for code, price in zip(columns.currency, columns.prices):
+        if price == price:  # nan != nan: release senza prezzo
+            by_currency.setdefault(code, array('d')).append(price)
+    result = {}
+    for code, prices in by_currency.items():
+        values = sorted(prices)
+        result[columns.currencies[code] or '?'] = dict(
+            releases=len(values), min=values[0], max=values[-1],
+            mean=round(math.fsum(values) / len(values), 2), **_quantiles(values)
+        )
+    return result
+
+def most_changed(columns, top):
+    """Le release con più variazioni di copie osservate (a pari merito, la più recente)."""
+    rows = heapq.nlargest(
+        top, (i for i, changes in enumerate(columns.changes) if changes > 0),
+        key=lambda i: (columns.changes[i], columns.last_change[i])
+    )
+    return [columns.row(i) for i in rows]
+
+def stale_releases(columns, hours, top, now):
+    """Release senza controllo da più di `hours` ore (le mai controllate contano a parte)."""
+    cutoff = now - hours * 3600
+    never = sum(1 for ts in columns.last_check if not ts)
+    stale = [i for i, ts in enumerate(columns.last_check) if 0 < ts < cutoff]
+    oldest = heapq.nsmallest(top, stale, key=columns.last_check.__getitem__)
+    return {
+        'hours': hours,
+        'count': len(stale),
+        'never_checked': never,
+        'oldest': [columns.row(i) for i in oldest],
+    }
 
-    except Exception as e:
-        logger.error(f"❌ Errore in monitor_stats_stable: {e}")
-        return 0
+def rotation_coverage(columns, now):
+    """Quante release sono state controllate entro ogni soglia, e distribuzione dell'età del controllo."""
+    ages = sorted(now - ts for ts in columns.last_check if ts)
+    total = len(columns)
+    if not ages:
+        return {'checked': 0, 'releases': total}
+    within = {}
+    for limit in ANALYTICS_AGE_BUCKETS:
+        checked = bisect.bisect_right(ages, limit)
+        within[f"{limit // 3600}h"] = {'releases': checked, 'share': round(checked / total, 4)}
+    checks = sorted(columns.checks)
+    return {
+        'releases': total,
+        'checked': len(ages),
+        'checked_within': within,
+        'age_seconds': dict(_quantiles(ages), max=ages[-1]),
+        'checks_per_release': dict(_quantiles(checks), max=checks[-1]),
+    }
+
+_analytics_lock = Lock()
+_analytics_columns = None
+_analytics_results = OrderedDict()   # (stale_hours, top) -> risultato, per _analytics_columns.version
+
+def analytics_report(snapshot, stale_hours=MAX_STALENESS_HOURS, top=ANALYTICS_TOP):
+    global _analytics_columns
+    with _analytics_lock:
+        if _analytics_columns is None or _analytics_columns.version != snapshot.version:
+            _analytics_columns = StatsColumns(snapshot)
+            _analytics_results.clear()
+        key = (stale_hours, top)
+        if key in _analytics_results:
+            _analytics_results.move_to_end(key)
+            return _analytics_results[key]
+        columns, now = _analytics_columns, time.time()
+        started = time.perf_counter()
+        result = {
+            'version': columns.version,
+            'generated_at': _iso_or_none(now),
+            'releases': len(columns),
+            'with_stats': sum(1 for count in columns.counts if count > 0),
+            'prices': price_distribution(columns),
+            'most_changed': most_changed(columns, top),
+            'stale': stale_releases(columns, stale_hours, top, now),
+            'coverage': rotation_coverage(columns, now),
+        }
+        result['compute_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        _analytics_results[key] = result
+        if len(_analytics_results) > ANALYTICS_CACHED_QUERIES:
+            _analytics_results.popitem(last=False)
+        return result
+
+# ================== LOG VIEWER ==================
+# Prima /logs leggeva e spezzava tutto il file (fino a 5 MB) per mostrarne 100
+# righe, ignorando i backup ruotati. Ora si legge all'indietro dalla fine, a
+# blocchi, passando ai file .1, .2, ... solo se servono altre righe. Con
+# format=json si legge LOG_JSON_FILE (stessi filtri, record strutturati).
+LOG_TAIL_BLOCK = 64 * 1024
+LOG_FOLLOW_POLL = 1.0          # secondi tra un controllo e l'altro in modalità follow
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+
+def log_files(base=LOG_FILE):
+    """File di log dal più recente al più vecchio (quello attivo, poi i backup ruotati)."""
+    paths = [base] + [f"{base}.{i}" for i in range(1, LOG_BACKUP_COUNT + 1)]
+    return [path for path in paths if os.path.exists(path)]
+
+def iter_lines_reversed(path, block_size=LOG_TAIL_BLOCK):
+    """Righe di un file dall'ultima alla prima, leggendo a blocchi dalla fine."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b""
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b"\n")
+            remainder = lines.pop(0)  # probabilmente incompleta: si completa col blocco prima
+            for line in reversed(lines):
+                if line:
+                    yield line.decode("utf-8", errors="replace")
+        if remainder:
+            yield remainder.decode("utf-8", errors="replace")
+
+def parse_log_line(line):
+    """Ritorna (datetime, livello) di una riga di log, o (None, None) se non è una riga intestata."""
+    try:
+        timestamp, level, _ = line.split(" - ", 2)
+        return datetime.strptime(timestamp[:19], "%Y-%m-%d %H:%M:%S"), level
+    except ValueError:
+        return None, None
+
+def parse_json_log_line(line):
+    """Come parse_log_line, per una riga di LOG_JSON_FILE."""
+    try:
+        record = json.loads(line)
+        return datetime.fromisoformat(record['ts']), record['level']
+    except (ValueError, KeyError, TypeError):
+        return None, None
+
+def make_log_filter(level=None, release_id=None, since=None, until=None, json_records=False):
+    """
+    Filtro per le righe di log. La release si confronta per intero: il campo
+    release_id nei record JSON, il token "(id N)" nelle righe di testo (una
+    sottostringa farebbe trovare 1234567 cercando 17, o tutto cercando 2026).
+    """
+    min_level = LOG_LEVELS.get((level or '').upper(), 0)
+    release_id = str(release_id) if release_id else None
+    token = f"(id {release_id})"
+
+    def has_release(line):
+        if not json_records:
+            return token in line
+        try:
+            return str(json.loads(line).get('release_id')) == release_id
+        except (ValueError, AttributeError):
+            return False
+
+    def matches(line):
+        ts, line_level = (parse_json_log_line if json_records else parse_log_line)(line)
+        if min_level and LOG_LEVELS.get(line_level, 0) < min_level:
+            return False
+        if (since or until) and ts is None:
+            return False
+        if since and ts < since:
+            return False
+        if until and ts > until:
+            return False
+        return release_id is None or has_release(line)
+
+    return matches
+
+def tail_logs(limit=100, level=None, release_id=None, since=None, until=None, json_records=False):
+    """Le ultime `limit` righe che passano i filtri, in ordine cronologico, anche dai file ruotati."""
+    parse = parse_json_log_line if json_records else parse_log_line
+    matches = make_log_filter(level, release_id, since, until, json_records)
+    found = []
+    for path in log_files(LOG_JSON_FILE if json_records else LOG_FILE):
+        for line in iter_lines_reversed(path):
+            if since:
+                ts, _ = parse(line)
+                if ts is not None and ts < since:
+                    return list(reversed(found))  # i file sono cronologici: più indietro è tutto più vecchio
+            if matches(line):
+                found.append(line)
+                if len(found) >= limit:
+                    return list(reversed(found))
+    return list(reversed(found))
+
+def follow_log(matches, path=LOG_FILE):
+    """Generatore di nuove righe del log attivo (tipo `tail -f`), gestisce la rotazione."""
+    f = None
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(path, "r", encoding="utf-8", errors="replace")
+                    f.seek(0, os.SEEK_END)
+                except OSError:
+                    time.sleep(LOG_FOLLOW_POLL)
+                    yield None
+                    continue
+            line = f.readline()
+            if line:
+                if matches(line.rstrip("\n")):
+                    yield line.rstrip("\n")
+                continue
+            # File ruotato (più corto della posizione attuale): si riapre dall'inizio
+            if os.path.exists(path) and os.path.getsize(path) < f.tell():
+                f.close()
+                f = open(path, "r", encoding="utf-8", errors="replace")
+                continue
+            time.sleep(LOG_FOLLOW_POLL)
+            yield None  # permette al chiamante di mandare un heartbeat
     finally:
-        CHECK_IN_PROGRESS = False
+        if f is not None:
+            f.close()
+
+def _parse_log_time(value):
+    if not value:
+        return None
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
 
 # ================== FLASK APP ==================
-app = Flask(__name__)
+# Le rotte stanno in un blueprint: create_app() costruisce l'app, sia per un
+# server WSGI (create_app('web') solo web, create_combined_app() con il monitor)
+# sia per la modalità a processo unico (vedi STARTUP per le topologie). Il web
+# non chiama mai Discogs: legge DB e snapshot e passa il lavoro al worker come job.
+web = Blueprint('web', __name__)
+WORKER_STALE_SECONDS = 120   # senza heartbeat da così tanto il worker è considerato fermo
 
 # === ENDPOINT EMERGENZA STOP/START ===
-@app.route("/stop")
+@web.route("/stop")
 def emergency_stop():
-    global EMERGENCY_STOP
-    EMERGENCY_STOP = True
+    control.set('emergency_stop', True)
     logger.critical("🛑🛑🛑 EMERGENZA - BOT BLOCCATO!")
     send_telegram("🛑 BOT BLOCCATO IN EMERGENZA - Nessuna notifica")
     return "<h1>🛑 BOT BLOCCATO</h1><p>Vai su /start per riattivare</p>", 200
 
-@app.route("/start")
+@web.route("/start")
 def emergency_start():
-    global EMERGENCY_STOP
-    EMERGENCY_STOP = False
+    control.set('emergency_stop', False)
     logger.warning("✅ Bot riattivato")
     send_telegram("✅ Bot RIATTIVATO - Notifiche attive")
     return "<h1>✅ Bot riattivato</h1>", 200
 
 # === ENDPOINT DI EMERGENZA RECUPERO ===
-@app.route("/fix-now")
+@web.route("/fix-now")
 def fix_now():
-    if CHECK_IN_PROGRESS:
-        return "<h1>⏳ Check già in corso!</h1><p>Attendi il completamento.</p><a href='/'>↩️ Home</a>", 429
-
-    logger.warning("🆘 AVVIO PROCEDURA DI RECUPERO EMERGENZA!")
-    wants = get_wantlist()[:30]
-    recovered = 0
-
-    for item in wants:
-        try:
-            release_id = str(item.get('id'))
-            basic_info = item.get('basic_information', {})
-            title = basic_info.get('title', 'Sconosciuto')
-            artists = basic_info.get('artists', [{}])
-            artist = artists[0].get('name', 'Sconosciuto') if artists else 'Sconosciuto'
-
-            stats = get_release_stats_stable(release_id)
-
-            if stats['num_for_sale'] > 0:
-                msg = (
-                    f"🆘 <b>RECUPERO EMERGENZA</b>\n\n"
-                    f"🎸 <b>{artist}</b>\n"
-                    f"💿 {title}\n\n"
-                    f"📦 <b>{stats['num_for_sale']} copie in vendita!</b>\n"
-                    f"💰 Prezzo più basso: {stats['currency']} {stats['price']}\n\n"
-                    f"🔗 <a href='https://www.discogs.com/sell/list?release_id={release_id}'>VERIFICA SU DISCOGS</a>"
-                )
-                if send_telegram(msg):
-                    recovered += 1
-                    logger.info(f"✅ Recuperata: {artist} - {title[:30]}...")
-
-        except Exception as e:
-            logger.error(f"❌ Errore recupero: {e}")
-
-    return f"<h1>✅ Procedura di recupero completata!</h1><p>Inviate {recovered} notifiche di recupero.</p><a href='/'>↩️ Home</a>", 200
+    job, created = job_manager.submit('fix-now')
+    title = "🆘 Procedura di recupero in coda!" if created else "⏳ Procedura di recupero già in coda"
+    return job_page(title, job), 202
 
 # === HOME ===
-@app.route("/")
+@web.route("/")
 def home():
-    cache = load_stats_cache()
-    monitored = len(cache)
-    with_stats = sum(1 for v in cache.values() if v.get('num_for_sale', 0) > 0)
+    snapshot = get_snapshot()
+    monitored, with_stats = snapshot.monitored, snapshot.with_stats
 
-    status = "🟢 ONLINE" if not EMERGENCY_STOP else "🔴 BLOCCATO"
-    check_status = "⏳ In corso" if CHECK_IN_PROGRESS else "✅ Libero"
+    stopped, running = control.stopped, control.cycle_running
+    status = "🟢 ONLINE" if not stopped else "🔴 BLOCCATO"
+    check_status = "⏳ In corso" if running else "✅ Libero"
+    worker_alive = worker_is_alive()
+    worker_status = "⚙️ Worker attivo" if worker_alive else "⚠️ Worker fermo"
 
     return f"""
     <!DOCTYPE html>
@@ -605,12 +3491,15 @@ def home():
             <h1>📊 Discogs Monitor - VERSIONE FINALE</h1>
 
             <div style="margin: 20px 0; text-align: center;">
-                <span class="status" style="background: {'#28a745' if not EMERGENCY_STOP else '#dc3545'};">
+                <span class="status" style="background: {'#28a745' if not stopped else '#dc3545'};">
                     {status}
                 </span>
-                <span class="status" style="background: {'#28a745' if not CHECK_IN_PROGRESS else '#ffc107'}; margin-left: 10px;">
+                <span class="status" style="background: {'#28a745' if not running else '#ffc107'}; margin-left: 10px;">
                     {check_status}
                 </span>
+                <span class="status" style="background: {'#28a745' if worker_alive else '#dc3545'}; margin-left: 10px;">
+                    {worker_status}
+                </span>
             </div>
 
             <div class="stats">
@@ -634,14 +3523,15 @@ def home():
                     <a class="btn" href="/test">🧪 Test</a>
                     <a class="btn" href="/reset">🔄 Reset Cache</a>
                     <a class="btn" href="/logs">📄 Logs</a>
+                    <a class="btn" href="/jobs">📋 Job</a>
+                    <a class="btn" href="/analytics">📈 Analytics</a>
                 </div>
             </div>
 
             <div style="background: #f8f9fa; padding: 15px; border-radius: 10px; margin-top: 20px;">
-                <p><strong>👤 Utente:</strong> {USERNAME}</p>
-                <p><strong>⏰ Intervallo tra cicli:</strong> {format_minutes(CHECK_INTERVAL)}</p>
-                <p><strong>🔍 Release per ciclo:</strong> {RELEASES_PER_CYCLE}</p>
-                <p><strong>🔄 Selezione:</strong> ROTAZIONE (meno controllate prima, non casuale)</p>
+                <p><strong>👤 Utenti:</strong> {', '.join(account.username or '?' for account in ACCOUNTS)}</p>
+                <p><strong>⏰ Controlli:</strong> {schedule_description()}</p>
+                <p><strong>🔄 Selezione:</strong> VOLATILITÀ (più probabili a cambiare prima, max {MAX_STALENESS_HOURS}h senza controllo)</p>
                 <p><strong>⚡ Rate Limiting:</strong> DINAMICO, budget condiviso (max {MAX_REQUESTS_PER_MINUTE}/min)</p>
                 <p><strong>✅ Stato:</strong> NOTIFICHE ATTIVE</p>
                 <p><strong>🛡️ ANTI-SPAM:</strong> Attivo (storico pulito ogni {NOTIFIED_RETENTION_DAYS} giorni)</p>
@@ -652,38 +3542,74 @@ def home():
     </html>
     """
 
-@app.route("/", methods=['HEAD'])
+@web.route("/", methods=['HEAD'])
 def home_head():
     return "", 200
 
-@app.route("/check")
+@web.route("/check")
 def manual_check():
-    if CHECK_IN_PROGRESS:
-        return "<h1>⏳ Check già in corso!</h1><p>Attendi il completamento prima di farne un altro.</p><a href='/'>↩️ Home</a>", 429
-    Thread(target=monitor_stats_stable, daemon=True).start()
-    return "<h1>🚀 Monitoraggio avviato!</h1><p>✅ Notifiche ATTIVE</p><a href='/'>↩️ Home</a>", 200
+    if control.stopped:
+        return "<h1>🔴 Bot bloccato</h1><p>Vai su /start per riattivare</p><a href='/'>↩️ Home</a>", 409
+    job, created = job_manager.submit('check')
+    title = "🚀 Monitoraggio in coda!" if created else "⏳ Monitoraggio già in coda"
+    return job_page(title, job), 202
 
-@app.route("/check", methods=['HEAD'])
+@web.route("/check", methods=['HEAD'])
 def check_head():
     return "", 200
 
-@app.route("/reset")
+def job_page(title, job):
+    if not worker_is_alive():
+        state = "⚠️ il worker non risponde, partirà quando torna attivo"
+    elif control.cycle_running:
+        state = "parte appena finisce il ciclo in corso"
+    else:
+        state = "parte subito"
+    return (
+        f"<h1>{title}</h1>"
+        f"<p>Job <b>{job['id']}</b> ({job['status']}), {state}.</p>"
+        f"<p>📈 <a href='/jobs/{job['id']}'>Avanzamento</a> · 🛑 <a href='/jobs/{job['id']}/cancel'>Annulla</a></p>"
+        f"<a href='/'>↩️ Home</a>"
+    )
+
+@web.route("/jobs")
+def list_jobs():
+    return jsonify(job_manager.list())
+
+@web.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': f"job {job_id} sconosciuto"}), 404
+    return jsonify(job)
+
+@web.route("/jobs/<job_id>/cancel")
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if not job:
+        return jsonify({'error': f"job {job_id} sconosciuto"}), 404
+    return jsonify(job)
+
+@web.route("/reset")
 def reset_cache():
-    save_stats_cache({})
-    save_notified(set())
-    logger.warning("🔄 CACHE E STORICO NOTIFICHE RESETTATI!")
-    return "<h1>🔄 Reset completo!</h1><p>Cache stats e storico notifiche puliti.</p><a href='/'>↩️ Home</a>", 200
+    job, created = job_manager.submit('reset')
+    title = "🔄 Reset in coda!" if created else "⏳ Reset già in coda"
+    return job_page(title, job), 202
 
-@app.route("/reset", methods=['HEAD'])
+@web.route("/reset", methods=['HEAD'])
 def reset_head():
     return "", 200
 
-@app.route("/debug")
+@web.route("/debug")
 def debug_release():
     release_id = request.args.get('id', '14809291')
-    stats = get_release_stats_stable(release_id)
-    cache = load_stats_cache()
-    cached = cache.get(release_id, {})
+    fresh = request.args.get('fresh') == '1'   # salta la cache delle stats
+    job, _ = job_manager.submit('debug', {'release_id': release_id, 'fresh': fresh})
+    job = wait_for_job(job['id'], DEBUG_WAIT_SECONDS)
+    if job['status'] != 'done':
+        return job_page(f"⏳ Debug release {release_id} non ancora pronto", job), 202
+    stats = job['result']
+    cached = get_snapshot().records.get(release_id, {})
 
     html = f"<h2>🔍 Debug Release {release_id}</h2>"
     html += f"<h3>📊 Stats Correnti (API):</h3>"
@@ -699,85 +3625,336 @@ def debug_release():
 
     return html, 200
 
-@app.route("/debug", methods=['HEAD'])
+@web.route("/debug", methods=['HEAD'])
 def debug_head():
     return "", 200
 
-@app.route("/test")
+@web.route("/test")
 def test_telegram():
-    success = send_telegram(
-        f"🧪 <b>Test - VERSIONE FINALE</b>\n\n"
-        f"✅ Sistema attivo - NOTIFICHE FUNZIONANTI\n"
-        f"👤 {USERNAME}\n"
-        f"🕐 {datetime.now().strftime('%H:%M %d/%m/%Y')}"
-    )
-    return "✅ Test inviato" if success else "❌ Errore", 200
-
-@app.route("/test", methods=['HEAD'])
+    results = []
+    for account in ACCOUNTS:
+        success = send_telegram(
+            f"🧪 <b>Test - VERSIONE FINALE</b>\n\n"
+            f"✅ Sistema attivo - NOTIFICHE FUNZIONANTI\n"
+            f"👤 {account.username}\n"
+            f"🕐 {datetime.now().strftime('%H:%M %d/%m/%Y')}",
+            account=account
+        )
+        results.append(f"{'✅ Test inviato' if success else '❌ Errore'} ({account.name})")
+    return "<br>".join(results), 200
+
+@web.route("/test", methods=['HEAD'])
 def test_head():
     return "", 200
 
-@app.route("/logs")
+@web.route("/logs")
 def view_logs():
+    """
+    Parametri opzionali: n (righe, max 2000), level (livello minimo), id (release),
+    since/until (es. 2024-05-01 10:00), follow=1 (stream live via SSE),
+    format=json (record strutturati: lista JSON, o un record per evento SSE).
+    """
+    level = request.args.get('level')
+    release_id = request.args.get('id')
+    since = _parse_log_time(request.args.get('since'))
+    until = _parse_log_time(request.args.get('until'))
+    json_records = request.args.get('format') == 'json'
+
+    if request.args.get('follow'):
+        if json_records:
+            matches = make_log_filter(level, release_id, json_records=True)
+            path = LOG_JSON_FILE
+        else:
+            matches = make_log_filter(level, release_id)
+            path = LOG_FILE
+
+        def events():
+            last_beat = time.time()
+            for line in follow_log(matches, path):
+                if line is not None:
+                    yield f"data: {line}\n\n"
+                elif time.time() - last_beat > 15:
+                    last_beat = time.time()
+                    yield ": heartbeat\n\n"
+
+        return Response(stream_with_context(events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    try:
+        limit = max(1, min(int(request.args.get('n', 100)), 2000))
+    except ValueError:
+        limit = 100
+
     try:
-        with open(LOG_FILE, "r") as f:
-            logs = f.read().splitlines()[-100:]
-        return "<pre style='background:#000; color:#0f0; padding:20px;'>" + "<br>".join(logs) + "</pre><br><a href='/'>↩️ Home</a>", 200
-    except:
+        logs = tail_logs(limit, level, release_id, since, until, json_records)
+    except OSError:
+        logs = []
+    if json_records:
+        records = []
+        for line in logs:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # riga troncata (es. processo terminato a metà scrittura)
+        return jsonify(records)
+    if not logs:
         return "<pre>Nessun log</pre><a href='/'>↩️ Home</a>", 200
 
-@app.route("/logs", methods=['HEAD'])
+    def render():
+        yield "<pre style='background:#000; color:#0f0; padding:20px;'>"
+        for line in logs:
+            yield html.escape(line) + "<br>"
+        yield "</pre><br><a href='/'>↩️ Home</a>"
+
+    return Response(stream_with_context(render()), mimetype="text/html")
+
+@web.route("/logs", methods=['HEAD'])
 def logs_head():
     return "", 200
 
-@app.route("/cache")
+@web.route("/cache")
 def view_cache():
-    cache = load_stats_cache()
-    html = f"<h2>💾 Stats Cache ({len(cache)} release)</h2><ul>"
-    for rid, data in list(cache.items())[:20]:
+    snapshot = get_snapshot()
+    html = f"<h2>💾 Stats Cache ({snapshot.monitored} release)</h2><ul>"
+    for rid, data in islice(snapshot.records.items(), 20):
         html += f"<li>{rid}: {data.get('num_for_sale', 0)} copie - {data.get('artist', '')[:20]}</li>"
     html += "</ul><a href='/'>↩️ Home</a>"
     return html, 200
 
-@app.route("/cache", methods=['HEAD'])
+@web.route("/history")
+def view_history():
+    """Storico di una release in JSON: /history?id=123&days=7"""
+    release_id = request.args.get('id')
+    if not release_id:
+        return jsonify({'error': 'parametro id mancante'}), 400
+    try:
+        days = float(request.args.get('days', 7))
+    except ValueError:
+        days = 7
+    # In un processo web separato la cache dello storico non vede le scritture del worker
+    samples = history_store.query(release_id, start=time.time() - days * 86400, fresh=PROCESS_ROLE == 'web')
+    return jsonify({
+        'release_id': release_id,
+        'samples': [{'ts': ts, 'num_for_sale': count, 'price': price} for ts, count, price in samples],
+    }), 200
+
+@web.route("/analytics")
+def view_analytics():
+    """Aggregati sulla cache in JSON: /analytics?stale_hours=24&top=20"""
+    try:
+        stale_hours = float(request.args.get('stale_hours', MAX_STALENESS_HOURS))
+        top = max(1, min(int(request.args.get('top', ANALYTICS_TOP)), ANALYTICS_TOP_MAX))
+    except ValueError:
+        return jsonify({'error': 'stale_hours e top devono essere numeri'}), 400
+    return jsonify(analytics_report(get_snapshot(), stale_hours, top)), 200
+
+@web.route("/profile")
+def view_profile():
+    """
+    /profile: cicli profilati salvati e riepilogo dell'ultimo.
+    /profile?cycles=N: profila i prossimi N cicli del worker (in modalità continua: N finestre).
+    """
+    if request.args.get('cycles'):
+        try:
+            cycles = max(1, min(int(request.args['cycles']), PROFILE_MAX_CYCLES))
+        except ValueError:
+            return jsonify({'error': 'cycles deve essere un numero'}), 400
+        control.set('profile_request', cycles)
+        logger.info(f"🔬 Profiling richiesto per i prossimi {cycles} cicli")
+        return jsonify({'armed': cycles}), 202
+    profiles = list_profiles()
+    latest = None
+    if profiles:
+        with open(os.path.join(PROFILE_DIR, f"{profiles[0]}.json")) as f:
+            latest = json.load(f)
+    return jsonify({'armed': control.get('profile_request'), 'profiles': profiles, 'latest': latest}), 200
+
+@web.route("/profile/<name>")
+def download_profile(name):
+    """/profile/<nome>: riepilogo JSON; /profile/<nome>.collapsed: stack per flamegraph."""
+    base, collapsed = (name[:-len('.collapsed')], True) if name.endswith('.collapsed') else (name, False)
+    if base not in list_profiles():
+        return jsonify({'error': 'profilo non trovato'}), 404
+    path = os.path.join(PROFILE_DIR, base + ('.collapsed' if collapsed else '.json'))
+    with open(path) as f:
+        data = f.read()
+    return Response(data, mimetype="text/plain" if collapsed else "application/json")
+
+@web.route("/traces")
+def view_traces():
+    """Trace dei cicli salvate (le più recenti prima): si aprono con ui.perfetto.dev."""
+    return jsonify({'traces': list_traces(), 'keep': TRACE_KEEP}), 200
+
+@web.route("/traces/<name>")
+def download_trace(name):
+    name = name[:-len('.json')] if name.endswith('.json') else name
+    if name not in list_traces():
+        return jsonify({'error': 'trace non trovata'}), 404
+    with open(os.path.join(TRACE_DIR, f"{name}.json")) as f:
+        data = f.read()
+    return Response(data, mimetype="application/json",
+                    headers={"Content-Disposition": f"attachment; filename={name}.json"})
+
+@web.route("/cache", methods=['HEAD'])
 def cache_head():
     return "", 200
 
-@app.route("/health")
+metrics.gauge('stats_cache_size', 'Release presenti in stats_cache', lambda: get_snapshot().monitored)
+metrics.gauge('stats_cache_with_stats', 'Release con copie in vendita', lambda: get_snapshot().with_stats)
+metrics.gauge('rate_limit_tokens', 'Token disponibili nel rate limiter', lambda: rate_limiter.tokens)
+metrics.gauge('telegram_queue_pending', 'Messaggi Telegram in coda', lambda: notification_queue.pending())
+
+def oldest_check_age():
+    oldest = [ts for ts in (index.oldest_check() for index in schedule_indexes.values()) if ts]
+    return time.time() - min(oldest) if oldest else 0
+
+metrics.gauge('oldest_check_age_seconds', 'Secondi dal controllo più vecchio in wantlist (revisita peggiore)', oldest_check_age)
+
+@web.route("/metrics")
+def view_metrics():
+    # Il monitor gira nel worker: il web espone l'ultima copia che il worker ha pubblicato
+    text = metrics.render() if PROCESS_ROLE != 'web' else control.get('worker_metrics', '')
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+@web.route("/health")
 def health_check():
     return "OK", 200
 
-@app.route("/health", methods=['HEAD'])
+@web.route("/health", methods=['HEAD'])
 def health_head():
     return "", 200
 
+def worker_is_alive():
+    heartbeat = control.get('worker_heartbeat')
+    return bool(heartbeat) and time.time() - heartbeat < WORKER_STALE_SECONDS
+
+def create_app(role='web'):
+    """App Flask. role='web' per un server WSGI (il worker è un processo a parte), 'all' per un processo unico."""
+    global PROCESS_ROLE
+    PROCESS_ROLE = role
+    if role == 'web':
+        # I file di log sono del worker: più processi che ruotano lo stesso file si pestano i piedi
+        start_log_writer(to_files=False)
+        # Lo snapshot si carica subito in background, non alla prima richiesta
+        Thread(target=refresh_snapshot_from_db, name="snapshot-warm-up", daemon=True).start()
+    app = Flask(__name__)
+    app.register_blueprint(web)
+    return app
+
 # ================== MAIN LOOP ==================
 def main_loop_stable():
-    global CHECK_IN_PROGRESS, EMERGENCY_STOP
-    time.sleep(10)
+    warmup_done.wait(WARMUP_TIMEOUT)
+    if SCHEDULER_MODE != 'batch':
+        if SCHEDULER_MODE != 'continuous':
+            logger.warning(f"⚠️ SCHEDULER_MODE '{SCHEDULER_MODE}' sconosciuto, uso 'continuous'")
+        ContinuousScheduler().run()
+        return
     while True:
         try:
-            if not EMERGENCY_STOP and not CHECK_IN_PROGRESS:
+            if not control.stopped and not control.cycle_running:
                 logger.info(f"\n{'='*70}")
                 logger.info(f"🔄 Monitoraggio automatico - {datetime.now().strftime('%H:%M:%S')}")
                 logger.info('='*70)
 
                 monitor_stats_stable()
-            elif CHECK_IN_PROGRESS:
+            elif control.cycle_running:
                 logger.info("⏳ Check manuale in corso, aspetto il prossimo ciclo")
 
             logger.info(f"💤 Pausa {format_minutes(CHECK_INTERVAL)}...")
-            time.sleep(CHECK_INTERVAL)
+            fixed_sleep(CHECK_INTERVAL, 'cycle_interval')
 
         except Exception as e:
             logger.error(f"❌ Loop error: {e}")
-            time.sleep(60)
+            fixed_sleep(60, 'loop_error')
+
+# ================== WORKER ==================
+# Il worker (monitor, job, coda Telegram) è l'unico processo che parla con
+# Discogs; ogni WORKER_STATUS_INTERVAL pubblica nel DB heartbeat e metriche
+# per il processo web.
+WORKER_STATUS_INTERVAL = 15
+
+def publish_worker_status():
+    while True:
+        try:
+            control.set('worker_heartbeat', time.time())
+            control.set('worker_metrics', metrics.render())
+        except Exception as e:
+            logger.error(f"❌ Errore pubblicazione stato worker: {e}")
+        time.sleep(WORKER_STATUS_INTERVAL)
+
+# Prima dell'avvio del server si scaricava tutta la wantlist (solo per contarla
+# nel messaggio di avvio) e poi il loop dormiva 10s fissi. Ora il server è in
+# ascolto subito, cache e wantlist salvate sono visibili da subito, e il
+# riscaldamento (refresh wantlist, messaggio di avvio) gira in background: il
+# primo ciclo parte appena ha finito.
+WARMUP_TIMEOUT = 300   # il primo ciclo parte comunque dopo questa attesa
+warmup_done = Event()
+
+def send_startup_message(wantlist_total):
+    send_telegram(
+        f"📊 <b>Discogs Monitor - VERSIONE FINALE</b>\n\n"
+        f"✅ <b>CONFIGURAZIONE:</b>\n"
+        f"• 🔄 Release scelte per VOLATILITÀ (max {MAX_STALENESS_HOURS}h senza controllo)\n"
+        f"• ⏰ Controlli: {schedule_description()}\n"
+        f"• ⚡ Rate limiting DINAMICO, budget condiviso (max {MAX_REQUESTS_PER_MINUTE}/min)\n"
+        f"• ✅ NOTIFICHE ATTIVE per aumenti\n"
+        f"• 🛡️ ANTI-SPAM attivo\n\n"
+        f"👤 {', '.join(account.username for account in ACCOUNTS)}\n"
+        f"📊 {wantlist_total} articoli in wantlist\n"
+        f"🕐 {datetime.now().strftime('%H:%M %d/%m/%Y')}"
+    )
+
+def warm_up():
+    started = time.perf_counter()
+    try:
+        # Prima ciò che è già su disco (niente rete): le pagine web sono subito utili
+        snapshot = get_snapshot()
+        saved = sum(len((load_wantlist_snapshot(account) or {}).get('items', [])) for account in ACCOUNTS)
+        logger.info(f"🔥 Stato caricato in {time.perf_counter() - started:.2f}s: "
+                    f"{snapshot.monitored} release in cache, {saved} articoli in wantlist salvata")
+        # Poi il refresh (incrementale se lo snapshot è recente) e il messaggio di avvio
+        wantlist_total = sum(len(get_wantlist(account=account)) for account in ACCOUNTS)
+        send_startup_message(wantlist_total)
+        logger.info(f"🔥 Riscaldamento completato in {time.perf_counter() - started:.1f}s")
+    except Exception as e:
+        logger.error(f"❌ Errore riscaldamento: {e}")
+    finally:
+        warmup_done.set()
+
+def start_worker():
+    """Avvia i thread del worker (deve girarne uno solo). Non blocca: niente rete qui."""
+    control.set('cycle_running', False)  # resta True se il worker precedente è morto a metà ciclo
+    job_manager.recover()
+    notification_queue.start()
+    job_manager.start()
+    Thread(target=publish_worker_status, name="worker-status", daemon=True).start()
+    Thread(target=warm_up, name="warm-up", daemon=True).start()
 
 # ================== STARTUP ==================
-if __name__ == "__main__":
+# Il Procfile separa il front-end dal monitor: le pagine web girano in più
+# processi gunicorn e non contendono mai il GIL al ciclo di fetch.
+#   gunicorn --workers N "main:create_app('web')"   -> solo web
+#   python main.py worker                           -> monitor, job e coda Telegram (uno solo)
+# I due processi condividono lo stato (control, jobs, stats_cache, heartbeat) e
+# i file di log solo attraverso DB_FILE e la cartella di lavoro: devono vedere
+# lo STESSO disco (stessa macchina o volume condiviso). Dove ogni tipo di
+# processo ha il suo disco (es. dyno Heroku) si usa il ripiego a processo unico,
+# con "worker" a zero:
+#   web: gunicorn --workers 1 --threads 8 "main:create_combined_app()"
+# (un solo worker gunicorn: ognuno avvierebbe il suo monitor).
+# Altri avvii:
+#   python main.py          -> web (server di Flask) e monitor nello stesso processo
+#   python main.py web      -> solo web, con il server di sviluppo di Flask
+def missing_config():
+    if os.environ.get("DISCOGS_ACCOUNTS"):
+        required = ('username', 'discogs_token', 'telegram_token', 'chat_id')
+        return [f"{account.name}.{field}" for account in ACCOUNTS for field in required if not getattr(account, field)]
     required = ["TELEGRAM_TOKEN", "CHAT_ID_GRUPPO", "DISCOGS_TOKEN", "DISCOGS_USERNAME"]
-    missing = [var for var in required if not os.environ.get(var)]
+    return [var for var in required if not os.environ.get(var)]
 
+def start_monitor():
+    """Controlla la configurazione, scrive il riepilogo e avvia worker e loop di monitoraggio."""
+    missing = missing_config()
     if missing:
         logger.error(f"❌ Variabili mancanti: {missing}")
         exit(1)
@@ -785,29 +3962,37 @@ if __name__ == "__main__":
     logger.info('='*70)
     logger.info("📊 DISCOGS MONITOR - VERSIONE FINALE CON NOTIFICHE")
     logger.info('='*70)
-    logger.info(f"👤 Utente: {USERNAME}")
-    logger.info(f"⏰ Intervallo: {format_minutes(CHECK_INTERVAL)}")
-    logger.info(f"🔍 Release/ciclo: {RELEASES_PER_CYCLE}")
-    logger.info(f"🔄 Selezione: ROTAZIONE (meno controllate prima)")
+    logger.info(f"👤 Utenti: {', '.join(account.username for account in ACCOUNTS)}")
+    logger.info(f"⏰ Controlli: {schedule_description()}")
+    logger.info(f"🔄 Selezione: VOLATILITÀ (più probabili a cambiare prima, max {MAX_STALENESS_HOURS}h senza controllo)")
     logger.info(f"⚡ Rate Limiting: DINAMICO, budget condiviso (max {MAX_REQUESTS_PER_MINUTE}/min)")
     logger.info(f"✅ NOTIFICHE: ATTIVE per AUMENTI")
     logger.info(f"🛡️ ANTI-SPAM: ATTIVO")
     logger.info('='*70)
 
-    send_telegram(
-        f"📊 <b>Discogs Monitor - VERSIONE FINALE</b>\n\n"
-        f"✅ <b>CONFIGURAZIONE:</b>\n"
-        f"• 🔄 {RELEASES_PER_CYCLE} release per ciclo, in ROTAZIONE (non più casuali)\n"
-        f"• ⏰ Controllo ogni {format_minutes(CHECK_INTERVAL)}\n"
-        f"• ⚡ Rate limiting DINAMICO, budget condiviso (max {MAX_REQUESTS_PER_MINUTE}/min)\n"
-        f"• ✅ NOTIFICHE ATTIVE per aumenti\n"
-        f"• 🛡️ ANTI-SPAM attivo\n\n"
-        f"👤 {USERNAME}\n"
-        f"📊 {len(get_wantlist())} articoli in wantlist\n"
-        f"🕐 {datetime.now().strftime('%H:%M %d/%m/%Y')}"
-    )
+    start_worker()
+    if PROCESS_ROLE != 'worker':
+        Thread(target=main_loop_stable, name="monitor", daemon=True).start()
+
+def create_combined_app():
+    """App WSGI con il monitor nello stesso processo (gunicorn --workers 1 "main:create_combined_app()")."""
+    app = create_app('all')
+    start_monitor()
+    return app
+
+if __name__ == "__main__":
+    PROCESS_ROLE = sys.argv[1] if len(sys.argv) > 1 else 'all'
+    if PROCESS_ROLE not in ('all', 'worker', 'web'):
+        logger.error(f"❌ Ruolo sconosciuto: {PROCESS_ROLE} (usa worker o web)")
+        exit(1)
 
-    Thread(target=main_loop_stable, daemon=True).start()
+    if PROCESS_ROLE == 'web':
+        create_app('web').run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)), debug=False)
+        exit(0)
 
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port, debug=False)
+    start_monitor()
+    if PROCESS_ROLE == 'worker':
+        main_loop_stable()
+    else:
+        port = int(os.environ.get("PORT", 8080))
+        create_app('all').run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# main.py scrive log, cache e DB nella cartella corrente: i test girano in una cartella temporanea
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="discogs-bot-tests-"))
@@ -0,0 +1,21 @@
+import json
+
+import main
+
+
+def test_builtin_blacklist_goes_to_the_legacy_account(monkeypatch):
+    monkeypatch.setattr(main, 'USERNAME', 'bob')
+    monkeypatch.setenv('DISCOGS_ACCOUNTS', json.dumps([
+        {'name': 'alice', 'username': 'alice', 'blacklist': ['1']},
+        {'name': 'bob', 'username': 'bob', 'blacklist': ['2']},
+    ]))
+    alice, bob = main.load_accounts()
+    assert alice.blacklist == {'1'}
+    assert bob.blacklist == main.BLACKLIST_SET | {'2'}
+
+
+def test_builtin_blacklist_falls_back_to_the_first_account(monkeypatch):
+    monkeypatch.setattr(main, 'USERNAME', 'nobody')
+    monkeypatch.setenv('DISCOGS_ACCOUNTS', json.dumps([{'name': 'alice', 'username': 'alice'}]))
+    alice, = main.load_accounts()
+    assert main.BLACKLIST_SET <= alice.blacklist
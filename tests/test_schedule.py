@@ -0,0 +1,56 @@
+from collections import Counter
+from datetime import datetime
+
+import main
+
+DAY = 86400
+
+
+def simulate(volatile, static, batch_size, rounds, step=300):
+    now = 1_800_000_000.0
+    first_seen = datetime.fromtimestamp(now - 100 * DAY).isoformat()
+    entries, wants = {}, []
+    for i in range(volatile + static):
+        entries[str(i)] = {'first_seen': first_seen, 'last_check': now - DAY, 'changes': 100 if i < volatile else 0}
+        wants.append({'id': i})
+    index = main.ScheduleIndex(blacklist=set())
+    index.sync_wants(wants, entries)
+    visits = Counter()
+    for _ in range(rounds):
+        now += step
+        for item in index.select(batch_size, now=now):
+            rid = str(item['id'])
+            visits[rid] += 1
+            entries[rid]['last_check'] = now
+            entries[rid]['next_due'] = index.update(rid, entries[rid])
+    return [visits[str(i)] for i in range(volatile)], [visits[str(i)] for i in range(volatile, volatile + static)]
+
+
+def test_volatile_releases_checked_more_often_than_static_ones():
+    # Meno release volatili che posti nel batch: non devono finire dietro alle statiche
+    volatile, static = simulate(volatile=10, static=190, batch_size=50, rounds=100)
+    assert min(volatile) > 3 * max(static)
+
+
+def test_every_release_is_still_visited():
+    volatile, static = simulate(volatile=10, static=190, batch_size=50, rounds=100)
+    assert min(static) > 0
+
+
+def test_new_release_starts_from_current_virtual_time():
+    now = 1_800_000_000.0
+    first_seen = datetime.fromtimestamp(now - 100 * DAY).isoformat()
+    entries = {str(i): {'first_seen': first_seen, 'last_check': now, 'changes': 0} for i in range(5)}
+    index = main.ScheduleIndex(blacklist=set())
+    wants = [{'id': i} for i in range(5)]
+    index.sync_wants(wants, entries)
+    for _ in range(20):
+        for item in index.select(5, now=now):
+            rid = str(item['id'])
+            entries[rid]['next_due'] = index.update(rid, entries[rid])
+    index.sync_wants(wants + [{'id': 99}], entries)
+    assert [item['id'] for item in index.select(1, now=now)] == [99]
+    entries['99'] = {'first_seen': first_seen, 'last_check': now, 'changes': 0}
+    due = index.update('99', entries['99'])
+    # Dopo il primo controllo non ha 20 giri di vantaggio sulle altre
+    assert due >= min(entries[str(i)]['next_due'] for i in range(5))
@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import main
+
+ITEM = {'id': 123, 'basic_information': {'title': 'Album', 'artists': [{'name': 'Artista'}]}}
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, num_for_sale):
+        self._data = {'num_for_sale': num_for_sale, 'lowest_price': {'value': 10.0, 'currency': 'EUR'}}
+
+    def json(self):
+        return self._data
+
+
+def failed_checks():
+    return main.metrics.collect()['counters'].get(('releases_checked_total', (('result', 'failed'),)), 0)
+
+
+def check(scheduler, item):
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = main.submit_stats(pool, item, main.load_stats_cache())
+        scheduler._in_flight[future] = item
+        future.exception()
+        scheduler._handle(future)
+
+
+def test_failed_fetch_backs_off_without_caching_zero_or_notifying(monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, 'enqueue_telegram', lambda msg, chat_id=None, account=None: sent.append(msg) or True)
+    main.save_stats_cache({'123': {
+        'num_for_sale': 3, 'price': 10.0, 'currency': 'EUR', 'first_seen': '2026-01-01T00:00:00',
+        'last_check': time.time() - 3600, 'changes': 0, 'checks': 1,
+    }})
+    scheduler = main.ContinuousScheduler(workers=1)
+
+    def unreachable(path, endpoint=None):
+        raise requests.ConnectionError("Discogs non raggiungibile")
+
+    monkeypatch.setattr(main.http_client, 'discogs_get', unreachable)
+    before = failed_checks()
+    check(scheduler, ITEM)
+
+    assert failed_checks() == before + 1
+    assert scheduler._failed['123'] > time.time()
+    assert main.load_stats_cache()['123']['num_for_sale'] == 3
+    assert sent == []
+
+    # Al controllo riuscito le copie sono le stesse di prima: nessun falso "nuove copie"
+    monkeypatch.setattr(main.http_client, 'discogs_get', lambda path, endpoint=None: FakeResponse(3))
+    check(scheduler, ITEM)
+
+    assert main.load_stats_cache()['123']['num_for_sale'] == 3
+    assert sent == []